@@ -0,0 +1,253 @@
+# coding=utf-8
+"""
+Brokers for the fleet simulator: an in-process stand-in, or a local broker such as
+mosquitto reached through paho-mqtt. Both hand out clients that provide the MQTT
+plugin's helpers and record every message the broker delivered.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import defaultdict, deque
+
+from .fakes import FakeMqtt
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+
+def topic_matches(pattern, topic):
+    """Whether topic matches a subscription pattern with + and # wildcards."""
+    _pattern = pattern.split("/")
+    _topic = topic.split("/")
+    for i, part in enumerate(_pattern):
+        if part == "#":
+            return True
+        if i >= len(_topic) or (part != "+" and part != _topic[i]):
+            return False
+    return len(_pattern) == len(_topic)
+
+
+class BrokerClient(object):
+    """
+    The MQTT plugin's helpers for one plugin instance. With retain every message is
+    retained, like the MQTT plugin does with its Retain option enabled.
+    """
+
+    def __init__(self, broker, name, retain=True):
+        self._broker = broker
+        self.name = name
+        self.retain = retain
+
+    def mqtt_publish(
+        self,
+        topic,
+        payload,
+        retained=False,
+        qos=0,
+        allow_queueing=False,
+        raw_data=False,
+    ):
+        return self._broker.publish(
+            topic, payload, retained=retained or self.retain, client=self
+        )
+
+    def mqtt_subscribe(self, topic, callback, *args, **kwargs):
+        self._broker.subscribe(topic, callback, client=self)
+
+    def mqtt_unsubscribe(self, callback, topic=None):
+        self._broker.unsubscribe(callback, topic=topic, client=self)
+
+    def helpers(self):
+        return {
+            "mqtt_publish": self.mqtt_publish,
+            "mqtt_subscribe": self.mqtt_subscribe,
+            "mqtt_unsubscribe": self.mqtt_unsubscribe,
+        }
+
+
+class LocalBroker(object):
+    """
+    Keeps retained messages, matches subscriptions and delivers from a single
+    thread, like a broker serving many clients would. Retained messages are
+    replayed on subscribe. The latency of a message is the time from publishing it
+    until it was delivered to all subscribers.
+    """
+
+    def __init__(self, retain=True):
+        self.retain = retain
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._retained = {}
+        self.deliveries = []
+        self._thread = threading.Thread(target=self._run, name="FleetBroker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def client(self, name):
+        return BrokerClient(self, name, self.retain)
+
+    def publish(self, topic, payload, retained=False, client=None):
+        self._queue.append((perf_counter(), topic, FakeMqtt.encode(payload), retained))
+        self._wakeup.set()
+        return True
+
+    def subscribe(self, topic, callback, client=None):
+        with self._lock:
+            self._subscriptions.append((topic, callback))
+        self._queue.append((self._replay, topic, callback))
+        self._wakeup.set()
+
+    def unsubscribe(self, callback, topic=None, client=None):
+        with self._lock:
+            self._subscriptions = [
+                (_topic, _callback)
+                for _topic, _callback in self._subscriptions
+                if not (_callback == callback and topic in (None, _topic))
+            ]
+
+    def drain(self, timeout=30):
+        """Wait until everything published before has been delivered."""
+        _done = threading.Event()
+        self._queue.append((_done.set,))
+        self._wakeup.set()
+        return _done.wait(timeout)
+
+    def retained_store(self):
+        _retained = list(self._retained.values())
+        return {"messages": len(_retained), "bytes": sum(len(p) for p in _retained)}
+
+    def close(self):
+        pass
+
+    def _replay(self, pattern, callback):
+        for _topic, _payload in list(self._retained.items()):
+            if topic_matches(pattern, _topic):
+                callback(_topic, _payload, retained=True, qos=0)
+
+    def _deliver(self, published, topic, payload, retained):
+        if retained:
+            if payload:
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+
+        with self._lock:
+            _callbacks = [c for t, c in self._subscriptions if topic_matches(t, topic)]
+        for _callback in _callbacks:
+            _callback(topic, payload, retained=False, qos=0)
+
+        _now = perf_counter()
+        self.deliveries.append((_now, topic, len(payload), _now - published))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                _item = self._queue.popleft()
+                try:
+                    if callable(_item[0]):
+                        _item[0](*_item[1:])
+                    else:
+                        self._deliver(*_item)
+                except Exception as e:
+                    print("Delivery failed: " + str(e))
+
+
+class MosquittoBroker(object):
+    """
+    A local broker reached through paho-mqtt, one connection per plugin instance.
+    An observer subscribed to the fleet's topics records the deliveries, the latency
+    of a message is the time from publishing it until the observer received it.
+    """
+
+    def __init__(self, host="localhost", port=1883, topics=("#",), retain=True):
+        import paho.mqtt.client  # noqa: F401
+
+        self.retain = retain
+        self._host = host
+        self._port = port
+        self._topics = topics
+        self._sent = defaultdict(deque)
+        self._clients = []
+        self.deliveries = []
+        self._observer = self._connect("fleet-observer")
+        self._observer.on_message = self._observe
+        for _topic in topics:
+            self._observer.subscribe(_topic)
+
+    def _connect(self, name):
+        import paho.mqtt.client as mqtt
+
+        try:
+            _client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=name)
+        except AttributeError:
+            # paho-mqtt before 2.0
+            _client = mqtt.Client(client_id=name)
+        _client.connect(self._host, self._port)
+        _client.loop_start()
+        self._clients.append(_client)
+        return _client
+
+    def client(self, name):
+        _client = BrokerClient(self, name, self.retain)
+        _client.connection = self._connect(name)
+        return _client
+
+    def publish(self, topic, payload, retained=False, client=None):
+        _connection = client.connection if client else self._observer
+        self._sent[topic].append(perf_counter())
+        _connection.publish(topic, FakeMqtt.encode(payload), retain=retained)
+        return True
+
+    def subscribe(self, topic, callback, client=None):
+        def on_message(_client, userdata, message):
+            callback(message.topic, message.payload, retained=message.retain, qos=0)
+
+        client.connection.message_callback_add(topic, on_message)
+        client.connection.subscribe(topic)
+
+    def unsubscribe(self, callback, topic=None, client=None):
+        if topic:
+            client.connection.message_callback_remove(topic)
+            client.connection.unsubscribe(topic)
+
+    def _observe(self, client, userdata, message):
+        if message.retain:
+            return
+        _now = perf_counter()
+        _sent = self._sent.get(message.topic)
+        _latency = _now - _sent.popleft() if _sent else None
+        self.deliveries.append((_now, message.topic, len(message.payload), _latency))
+
+    def drain(self, timeout=30):
+        _deadline = perf_counter() + timeout
+        while any(self._sent.values()) and perf_counter() < _deadline:
+            time.sleep(0.05)
+        return not any(self._sent.values())
+
+    def retained_store(self):
+        _retained = {}
+
+        def on_message(client, userdata, message):
+            if message.retain:
+                _retained[message.topic] = len(message.payload)
+
+        _client = self._connect("fleet-retained")
+        _client.on_message = on_message
+        for _topic in self._topics:
+            _client.subscribe(_topic)
+        time.sleep(2)
+        _client.loop_stop()
+        _client.disconnect()
+        return {"messages": len(_retained), "bytes": sum(_retained.values())}
+
+    def close(self):
+        for _client in self._clients:
+            _client.loop_stop()
+            _client.disconnect()
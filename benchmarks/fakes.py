@@ -0,0 +1,427 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import contextlib
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+
+class FakeClock(object):
+    """Stands in for the time module where simulated time is needed."""
+
+    def __init__(self, start=1600000000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSettings(object):
+    """Plugin settings, backed by a plain dict of the plugin's own settings."""
+
+    def __init__(self, defaults, overrides=None, global_settings=None):
+        self._data = dict(defaults)
+        self._data.update(overrides or {})
+        self._global = global_settings or {}
+
+    def get(self, path, **kwargs):
+        return self._data.get(path[0])
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def set(self, path, value, **kwargs):
+        self._data[path[0]] = value
+
+    def global_get(self, path, **kwargs):
+        return self._global.get(tuple(path))
+
+    def save(self, *args, **kwargs):
+        pass
+
+
+class FakePrinter(object):
+    """A printer running a single job, advanced by calling advance()."""
+
+    def __init__(self, duration=3600, layer_height=0.2, layers=200):
+        self.duration = duration
+        self.layer_height = layer_height
+        self.layers = layers
+        self.state = "Operational"
+        self.print_time = None
+        self.current_z = None
+        self.commands_sent = []
+
+    def start(self):
+        self.state = "Printing"
+        self.print_time = 0
+        self.current_z = self.layer_height
+
+    def finish(self):
+        self.state = "Operational"
+
+    def set_progress(self, completion):
+        if self.print_time is None:
+            self.start()
+        self.print_time = self.duration * completion / 100.0
+
+    def advance(self, seconds):
+        self.print_time += seconds
+        layer = int(self.print_time * self.layers / self.duration) + 1
+        self.current_z = round(min(layer, self.layers) * self.layer_height, 2)
+
+    @property
+    def completion(self):
+        if self.print_time is None:
+            return None
+        return min(100.0, 100.0 * self.print_time / self.duration)
+
+    def is_printing(self):
+        return self.state == "Printing"
+
+    def is_paused(self):
+        return self.state == "Paused"
+
+    def get_current_connection(self):
+        return self.state, "/dev/ttyACM0", 115200, None
+
+    def get_current_data(self):
+        printing = self.state == "Printing"
+        return {
+            "state": {
+                "text": self.state,
+                "flags": {
+                    "operational": True,
+                    "printing": printing,
+                    "cancelling": False,
+                    "pausing": False,
+                    "resuming": False,
+                    "finishing": False,
+                    "closedOrError": False,
+                    "error": False,
+                    "paused": self.state == "Paused",
+                    "ready": not printing,
+                    "sdReady": False,
+                },
+                "error": "",
+            },
+            "job": {
+                "file": {
+                    "name": "benchmark.gcode",
+                    "path": "benchmark.gcode",
+                    "display": "benchmark.gcode",
+                    "origin": "local",
+                    "size": 4823712,
+                    "date": 1600000000,
+                },
+                "estimatedPrintTime": self.duration,
+                "averagePrintTime": None,
+                "lastPrintTime": None,
+                "filament": {"tool0": {"length": 12034.5, "volume": 28.9}},
+                "user": "benchmark",
+            },
+            "progress": {
+                "completion": self.completion,
+                "filepos": None,
+                "printTime": self.print_time,
+                "printTimeLeft": None
+                if self.print_time is None
+                else max(0, self.duration - self.print_time),
+                "printTimeLeftOrigin": "estimate",
+            },
+            "currentZ": self.current_z,
+            "offsets": {},
+            "resends": {"count": 0, "transmitted": 0, "ratio": 0},
+            "logs": ["Send: N123 G1 X10 Y10*45", "Recv: ok"] * 5,
+            "messages": ["ok"] * 5,
+        }
+
+    def commands(self, commands, *args, **kwargs):
+        self.commands_sent.append(commands)
+
+    def jog(self, axes, *args, **kwargs):
+        self.commands_sent.append(("jog", axes))
+
+    def home(self, axes, *args, **kwargs):
+        self.commands_sent.append(("home", axes))
+
+    def cancel_print(self, *args, **kwargs):
+        self.finish()
+
+    def pause_print(self, *args, **kwargs):
+        self.state = "Paused"
+
+    def resume_print(self, *args, **kwargs):
+        self.state = "Printing"
+
+
+class SimulatedTrigger(object):
+    """Coalesces status triggers on simulated time, like CoalescingTrigger does."""
+
+    def __init__(self, callback, clock, window):
+        self._callback = callback
+        self._clock = clock
+        self.window = window
+        self.due = None
+
+    def trigger(self, immediate=False):
+        if immediate or self.window <= 0:
+            self.due = None
+            self._callback()
+        elif self.due is None:
+            self.due = self._clock.time() + self.window
+
+    def cancel(self):
+        self.due = None
+
+    def poll(self):
+        if self.due is not None and self._clock.time() >= self.due:
+            self.due = None
+            self._callback()
+
+
+class SimulatedScheduler(object):
+    """Runs the plugin's scheduled jobs on simulated time."""
+
+    def __init__(self, plugin, clock):
+        self._plugin = plugin
+        self._clock = clock
+        self._jobs = {
+            "status": plugin.handle_timer,
+            "soc": plugin.handle_constant_timer,
+            "broker": plugin._probe_broker,
+        }
+        self._due = dict((name, clock.time()) for name in self._jobs)
+
+    def reschedule(self):
+        for name in self._jobs:
+            self._due[name] = self._clock.time()
+
+    def poll(self):
+        for name, callback in self._jobs.items():
+            if self._clock.time() < self._due[name]:
+                continue
+            interval = self._plugin._get_interval(name)
+            if interval:
+                callback()
+            # A disabled job is asked for its interval again after a minute
+            self._due[name] = self._clock.time() + (interval or 60)
+
+
+class SimulatedPublisher(object):
+    """Runs publishing right away, so messages are recorded at the simulated time."""
+
+    def submit(self, key, operation):
+        operation()
+        return True
+
+    def join(self, timeout=None):
+        return True
+
+    def stop(self, timeout=None):
+        pass
+
+
+@contextlib.contextmanager
+def simulated_time(plugin, clock):
+    """
+    Run the plugin's time based publishing on clock: status tracking, coalescing
+    of status updates, the scheduled jobs and publishing itself. Yields a function that has to be
+    called whenever the clock advanced.
+    """
+    import octoprint_homeassistant.status as status_module
+
+    plugin._scheduler.stop()
+    trigger = SimulatedTrigger(
+        plugin._generate_printer_status,
+        clock,
+        plugin._settings.get_float(["status_coalesce_window"]),
+    )
+    scheduler = SimulatedScheduler(plugin, clock)
+    real_time, status_module.time = status_module.time, clock
+    real_trigger, plugin._status_trigger = plugin._status_trigger, trigger
+    plugin._publisher.join()
+    real_publisher, plugin._publisher = plugin._publisher, SimulatedPublisher()
+    real_reschedule, plugin._scheduler.reschedule = (
+        plugin._scheduler.reschedule,
+        scheduler.reschedule,
+    )
+
+    def poll():
+        trigger.poll()
+        scheduler.poll()
+
+    try:
+        yield poll
+    finally:
+        status_module.time = real_time
+        plugin._status_trigger = real_trigger
+        plugin._publisher = real_publisher
+        plugin._scheduler.reschedule = real_reschedule
+
+
+class FakePrinterProfileManager(object):
+    def __init__(self, extruders=1, heated_chamber=False):
+        self.profile = {
+            "id": "_default",
+            "extruder": {"count": extruders},
+            "heatedChamber": heated_chamber,
+        }
+
+    def get_current_or_default(self):
+        return self.profile
+
+
+class FakeMqtt(object):
+    """Records what the plugin publishes through the MQTT plugin's helpers."""
+
+    def __init__(self, clock=None):
+        self.clock = clock or time
+        self.connected = True
+        self.messages = []
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.messages = []
+
+    @staticmethod
+    def encode(payload):
+        if isinstance(payload, bytes):
+            return payload
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        return payload.encode("utf-8")
+
+    def mqtt_publish(
+        self,
+        topic,
+        payload,
+        retained=False,
+        qos=0,
+        allow_queueing=False,
+        raw_data=False,
+    ):
+        if not self.connected and not allow_queueing:
+            return False
+        payload = self.encode(payload)
+        with self._lock:
+            self.messages.append((self.clock.time(), topic, len(payload), retained))
+        return True
+
+    def mqtt_publish_with_timestamp(self, topic, payload, **kwargs):
+        payload = dict(payload)
+        payload["_timestamp"] = int(self.clock.time())
+        return self.mqtt_publish(topic, payload, **kwargs)
+
+    def mqtt_subscribe(self, topic, callback, *args, **kwargs):
+        self.subscriptions[topic] = callback
+
+    def mqtt_unsubscribe(self, callback, topic=None):
+        for _topic, _callback in list(self.subscriptions.items()):
+            if _callback == callback and topic in (None, _topic):
+                del self.subscriptions[_topic]
+
+    def deliver(self, topic, message, retained=False):
+        callback = self.subscriptions.get(topic)
+        if callback:
+            callback(topic, message, retained=retained, qos=0)
+
+    def helpers(self):
+        return {
+            "mqtt_publish": self.mqtt_publish,
+            "mqtt_publish_with_timestamp": self.mqtt_publish_with_timestamp,
+            "mqtt_subscribe": self.mqtt_subscribe,
+            "mqtt_unsubscribe": self.mqtt_unsubscribe,
+        }
+
+    def stats(self, since=None):
+        messages = [m for m in self.messages if since is None or m[0] >= since]
+        return {
+            "messages": len(messages),
+            "bytes": sum(m[2] for m in messages),
+        }
+
+
+class FakePluginManager(object):
+    def __init__(self, mqtt, psucontrol=False):
+        self._mqtt = mqtt
+        self._psucontrol = psucontrol
+        self.psu_state = False
+
+    def get_helpers(self, name, *helpers):
+        if name == "mqtt":
+            return self._mqtt.helpers()
+        if name == "psucontrol" and self._psucontrol:
+            return {
+                "get_psu_state": lambda: self.psu_state,
+                "turn_psu_on": lambda: setattr(self, "psu_state", True),
+                "turn_psu_off": lambda: setattr(self, "psu_state", False),
+            }
+        return None
+
+
+_settings_basedir = None
+
+
+def init_octoprint_settings():
+    """Initialize OctoPrint's global settings in a temporary base directory."""
+    global _settings_basedir
+    if _settings_basedir is None:
+        from octoprint.settings import settings
+
+        _settings_basedir = tempfile.mkdtemp(prefix="homeassistant-bench-")
+        settings(init=True, basedir=_settings_basedir)
+    return _settings_basedir
+
+
+def make_plugin(
+    settings=None,
+    printer=None,
+    profile_manager=None,
+    mqtt=None,
+    node_id="BENCH",
+    psucontrol=False,
+    data_folder=None,
+):
+    """Create a HomeassistantPlugin wired to fakes, as the plugin manager would."""
+    init_octoprint_settings()
+
+    from octoprint_homeassistant import HomeassistantPlugin
+
+    plugin = HomeassistantPlugin()
+    # Unpaced discovery, the benchmarks measure the plugin's own work
+    overrides = dict(unique_id=node_id, node_id=node_id, discovery_rate=0)
+    overrides.update(settings or {})
+    plugin._settings = FakeSettings(plugin.get_settings_defaults(), overrides)
+    plugin._printer = printer or FakePrinter()
+    plugin._printer_profile_manager = profile_manager or FakePrinterProfileManager()
+    plugin._plugin_manager = FakePluginManager(mqtt or FakeMqtt(), psucontrol)
+    plugin._plugin_version = "bench"
+    plugin._identifier = "homeassistant"
+    plugin._logger = logging.getLogger("benchmark.homeassistant." + node_id)
+    plugin._data_folder = data_folder or tempfile.mkdtemp(
+        prefix="homeassistant-" + node_id + "-"
+    )
+    return plugin
+
+
+def remove_plugin(plugin):
+    plugin.on_shutdown()
+    shutil.rmtree(plugin._data_folder, ignore_errors=True)
@@ -0,0 +1,305 @@
+# coding=utf-8
+"""
+Run a fleet of plugin instances against one broker to size it.
+
+    python -m benchmarks.fleet --instances 50 --duration 120 --restarts 2
+
+Every instance has its own node id, base topic and fake printer, and runs
+back-to-back prints at --speed times real time. Home Assistant restarts are
+simulated by publishing offline and online on its status topic. The fleet runs
+against an in-process broker stand-in, or with --broker host:port against a local
+broker such as mosquitto, which requires paho-mqtt. Requires OctoPrint to be
+installed in the same environment as the plugin.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from .broker import LocalBroker, MosquittoBroker
+from .fakes import FakePrinter, init_octoprint_settings, make_plugin, remove_plugin
+from .hotpaths import summarize
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+DISCOVERY_TOPIC = "homeassistant"
+BASE_TOPIC = "fleet/"
+
+
+class Instance(object):
+    """One plugin instance and the script of the prints it runs."""
+
+    def __init__(self, plugin, printer, print_duration, first_start):
+        self.plugin = plugin
+        self.printer = printer
+        self.print_duration = print_duration
+        self.next_start = first_start
+        self.last_z = None
+        self.last_progress = -1
+        self.prints = 0
+
+    def step(self, now, seconds):
+        from octoprint.events import Events
+
+        if not self.printer.is_printing():
+            if now < self.next_start:
+                return
+            self.printer.start()
+            self.plugin.on_event(Events.PRINT_STARTED, {})
+            self.last_z = None
+            self.last_progress = -1
+            return
+
+        self.printer.advance(seconds)
+        if self.printer.current_z != self.last_z:
+            self.last_z = self.printer.current_z
+            self.plugin.on_event(Events.Z_CHANGE, {"new": self.last_z})
+        if int(self.printer.completion) != self.last_progress:
+            self.last_progress = int(self.printer.completion)
+            self.plugin.on_print_progress("local", "fleet.gcode", self.last_progress)
+        if self.printer.print_time >= self.print_duration:
+            self.printer.finish()
+            self.plugin.on_event(Events.PRINT_DONE, {})
+            self.prints += 1
+            # Take the print off the bed
+            self.next_start = now + random.uniform(5, 30)
+
+
+def start_instance(broker, index, settings, print_duration, layers, first_start):
+    from octoprint.settings import settings as global_settings
+
+    node_id = "FLEET%03d" % index
+    printer = FakePrinter(duration=print_duration, layers=layers)
+    plugin = make_plugin(
+        settings=dict(settings, discovery_topic=DISCOVERY_TOPIC),
+        printer=printer,
+        mqtt=broker.client(node_id),
+        node_id=node_id,
+    )
+    # The MQTT plugin's topics are global settings, shared by every instance in this
+    # process. Each instance needs its own base topic, build its topics with it.
+    global_settings().set(
+        ["plugins", "mqtt", "publish", "baseTopic"], BASE_TOPIC + node_id + "/"
+    )
+    plugin._build_topic_table()
+    plugin.on_after_startup()
+    return Instance(plugin, printer, print_duration, first_start)
+
+
+def storm(deliveries, start, end=None):
+    """The discovery messages delivered from start until end."""
+    configs = [
+        d
+        for d in deliveries
+        if d[0] >= start
+        and (end is None or d[0] < end)
+        and d[1].startswith(DISCOVERY_TOPIC + "/")
+        and d[1].endswith("/config")
+    ]
+    return {
+        "messages": len(configs),
+        "bytes": sum(d[2] for d in configs),
+        "seconds": configs[-1][0] - start if configs else 0,
+    }
+
+
+def wait_registered(instances, timeout=600):
+    """Wait for pending re-registrations and the messages they published."""
+    deadline = perf_counter() + timeout
+    for instance in instances:
+        instance.plugin._started.wait(max(0, deadline - perf_counter()))
+        timer = instance.plugin._registration_timer
+        if timer is not None:
+            timer.join(max(0, deadline - perf_counter()))
+        instance.plugin._discovery_publisher.join(max(0, deadline - perf_counter()))
+        instance.plugin._publisher.join(max(0, deadline - perf_counter()))
+
+
+def run_fleet(
+    broker,
+    instances=10,
+    duration=60,
+    restarts=1,
+    speed=60,
+    print_duration=3600,
+    layers=200,
+    step=0.5,
+    settings=None,
+):
+    init_octoprint_settings()
+
+    start = perf_counter()
+    fleet = [
+        start_instance(
+            broker,
+            i,
+            settings or {},
+            print_duration,
+            layers,
+            start + random.uniform(0, duration / 4.0),
+        )
+        for i in range(instances)
+    ]
+    wait_registered(fleet)
+    broker.drain()
+    startup = storm(broker.deliveries, start)
+
+    # Home Assistant comes back a few seconds after it went offline
+    restart_times = [
+        start + duration * (k + 1) / (restarts + 1.0) for k in range(restarts)
+    ]
+    online_times = []
+    try:
+        now = perf_counter()
+        while now - start < duration:
+            if restart_times and now >= restart_times[0]:
+                restart_times.pop(0)
+                broker.publish(DISCOVERY_TOPIC + "/status", "offline")
+                time.sleep(2)
+                broker.publish(DISCOVERY_TOPIC + "/status", "online")
+                online_times.append(perf_counter())
+
+            for instance in fleet:
+                instance.step(now, step * speed)
+            time.sleep(max(0, step - (perf_counter() - now)))
+            now = perf_counter()
+
+        wait_registered(fleet)
+        broker.drain()
+        elapsed = perf_counter() - start
+
+        deliveries = broker.deliveries
+        per_second = {}
+        for d in deliveries:
+            second = int(d[0] - start)
+            per_second[second] = per_second.get(second, 0) + 1
+
+        storms = [
+            storm(
+                deliveries,
+                online,
+                online_times[k + 1] if k + 1 < len(online_times) else None,
+            )
+            for k, online in enumerate(online_times)
+        ]
+        return dict(
+            instances=instances,
+            seconds=elapsed,
+            prints=sum(instance.prints for instance in fleet),
+            messages=len(deliveries),
+            bytes=sum(d[2] for d in deliveries),
+            messages_per_second=len(deliveries) / elapsed,
+            peak_messages_per_second=max(per_second.values()) if per_second else 0,
+            retained=broker.retained_store(),
+            latency=summarize([d[3] for d in deliveries if d[3] is not None]),
+            registration=dict(
+                startup=startup,
+                restarts=storms,
+                restart_seconds=summarize([s["seconds"] for s in storms]),
+            ),
+        )
+    finally:
+        for instance in fleet:
+            remove_plugin(instance.plugin)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument(
+        "--duration", type=float, default=60, help="Real seconds to run the fleet for"
+    )
+    parser.add_argument(
+        "--restarts", type=int, default=1, help="Home Assistant restarts to simulate"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=60, help="Print time per real second"
+    )
+    parser.add_argument("--print-duration", type=int, default=3600)
+    parser.add_argument("--layers", type=int, default=200)
+    parser.add_argument(
+        "--broker",
+        metavar="HOST:PORT",
+        help="Run against this local broker instead of the in-process stand-in",
+    )
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override a plugin setting, the value is parsed as JSON",
+    )
+    parser.add_argument(
+        "--no-retain",
+        action="store_true",
+        help="Like the MQTT plugin with its Retain option disabled",
+    )
+    parser.add_argument("--seed", type=int, help="Seed the print start times")
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args(argv)
+
+    from octoprint_homeassistant import SETTINGS_DEFAULTS
+
+    # Discovery is paced as it is in production, unless overridden
+    settings = dict(discovery_rate=SETTINGS_DEFAULTS["discovery_rate"])
+    for setting in args.setting:
+        key, _, value = setting.partition("=")
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        broker = MosquittoBroker(
+            host,
+            int(port or 1883),
+            topics=(DISCOVERY_TOPIC + "/#", BASE_TOPIC + "#"),
+            retain=not args.no_retain,
+        )
+    else:
+        broker = LocalBroker(retain=not args.no_retain)
+
+    try:
+        results = dict(
+            meta={
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "broker": args.broker or "in-process",
+                "settings": settings,
+            },
+            fleet=run_fleet(
+                broker,
+                instances=args.instances,
+                duration=args.duration,
+                restarts=args.restarts,
+                speed=args.speed,
+                print_duration=args.print_duration,
+                layers=args.layers,
+                settings=settings,
+            ),
+        )
+    finally:
+        broker.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
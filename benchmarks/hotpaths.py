@@ -0,0 +1,233 @@
+# coding=utf-8
+"""
+Benchmarks for the hot paths of the plugin, run against in-process fakes.
+
+    python -m benchmarks.hotpaths --output results.json
+
+Requires OctoPrint to be installed in the same environment as the plugin.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from .fakes import (
+    FakeClock,
+    FakeMqtt,
+    FakePrinter,
+    make_plugin,
+    remove_plugin,
+    simulated_time,
+)
+
+try:
+    from time import perf_counter, process_time
+except ImportError:
+    from time import clock as process_time
+    from time import time as perf_counter
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "min": samples[0],
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+    }
+
+
+def started_plugin(**kwargs):
+    plugin = make_plugin(**kwargs)
+    plugin.on_after_startup()
+    plugin._started.wait()
+    plugin._publisher.join()
+    # Background jobs would skew the measurements, the benchmarks drive them
+    plugin._scheduler.stop()
+    return plugin
+
+
+def bench_startup(iterations):
+    """Time until on_after_startup returns and until the background startup is done."""
+    returned, started = [], []
+    for _ in range(iterations):
+        plugin = make_plugin(mqtt=FakeMqtt())
+        try:
+            start = perf_counter()
+            plugin.on_after_startup()
+            returned.append(perf_counter() - start)
+            plugin._started.wait()
+            started.append(perf_counter() - start)
+        finally:
+            remove_plugin(plugin)
+    return {"returned": summarize(returned), "started": summarize(started)}
+
+
+def bench_registration(iterations):
+    mqtt = FakeMqtt()
+    plugin = started_plugin(mqtt=mqtt, settings={"status_coalesce_window": 0})
+    results = {}
+    try:
+        for mode, clear in (("cold", True), ("warm", False)):
+            samples = []
+            for _ in range(iterations):
+                if clear:
+                    plugin._discovery_ledger.clear()
+                mqtt.reset()
+                start = perf_counter()
+                plugin._register_discovery(subscribe=False)
+                plugin._publisher.join()
+                samples.append(perf_counter() - start)
+            results[mode] = dict(seconds=summarize(samples), **mqtt.stats())
+    finally:
+        remove_plugin(plugin)
+    return results
+
+
+def bench_printer_status(iterations):
+    mqtt = FakeMqtt()
+    printer = FakePrinter()
+    plugin = started_plugin(
+        mqtt=mqtt, printer=printer, settings={"status_coalesce_window": 0}
+    )
+    try:
+        printer.start()
+        mqtt.reset()
+        samples = []
+        for _ in range(iterations):
+            printer.advance(1)
+            start = perf_counter()
+            plugin._generate_printer_status()
+            plugin._publisher.join()
+            samples.append(perf_counter() - start)
+        return dict(seconds=summarize(samples), **mqtt.stats())
+    finally:
+        remove_plugin(plugin)
+
+
+def bench_event_storm(events, window):
+    from octoprint.events import Events
+
+    storm = (Events.Z_CHANGE, Events.PRINTER_STATE_CHANGED, Events.Z_CHANGE)
+
+    mqtt = FakeMqtt()
+    printer = FakePrinter()
+    plugin = started_plugin(
+        mqtt=mqtt, printer=printer, settings={"status_coalesce_window": window}
+    )
+    try:
+        printer.start()
+        mqtt.reset()
+        start = perf_counter()
+        for i in range(events):
+            printer.advance(0.1)
+            plugin.on_event(storm[i % len(storm)], {})
+            plugin.on_print_progress("local", "benchmark.gcode", i % 100)
+        elapsed = perf_counter() - start
+        # Let a pending coalesced update go out before counting
+        time.sleep(window + 0.2)
+        plugin._publisher.join()
+        return dict(
+            events=events * 2,
+            seconds=elapsed,
+            events_per_second=events * 2 / elapsed if elapsed else None,
+            **mqtt.stats()
+        )
+    finally:
+        remove_plugin(plugin)
+
+
+def bench_simulated_print(duration, layers):
+    """Run a print of duration simulated seconds, returns the publish rate."""
+    from octoprint.events import Events
+
+    clock = FakeClock()
+    mqtt = FakeMqtt(clock=clock)
+    printer = FakePrinter(duration=duration, layers=layers)
+    plugin = started_plugin(mqtt=mqtt, printer=printer)
+
+    cpu_start = process_time()
+    try:
+        with simulated_time(plugin, clock) as poll:
+            mqtt.reset()
+            start = clock.time()
+            printer.start()
+            plugin.on_event(Events.PRINT_STARTED, {})
+
+            last_z = printer.current_z
+            last_progress = -1
+            step = 0.1
+            while printer.print_time < duration:
+                clock.sleep(step)
+                printer.advance(step)
+                if printer.current_z != last_z:
+                    last_z = printer.current_z
+                    plugin.on_event(Events.Z_CHANGE, {"new": last_z})
+                if int(printer.completion) != last_progress:
+                    last_progress = int(printer.completion)
+                    plugin.on_print_progress("local", "benchmark.gcode", last_progress)
+                poll()
+
+            printer.finish()
+            plugin.on_event(Events.PRINT_DONE, {})
+            minutes = (clock.time() - start) / 60.0
+
+        stats = mqtt.stats()
+        return dict(
+            simulated_seconds=duration,
+            layers=layers,
+            messages_per_minute=stats["messages"] / minutes,
+            bytes_per_minute=stats["bytes"] / minutes,
+            cpu_seconds=process_time() - cpu_start,
+            **stats
+        )
+    finally:
+        remove_plugin(plugin)
+
+
+def run(args):
+    import octoprint_homeassistant
+
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "plugin": getattr(octoprint_homeassistant, "__file__", None),
+        },
+        "startup": bench_startup(args.iterations),
+        "registration": bench_registration(args.iterations),
+        "printer_status": bench_printer_status(args.iterations * 10),
+        "event_storm": bench_event_storm(args.events, args.window),
+        "simulated_print": bench_simulated_print(args.print_duration, args.layers),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--window", type=float, default=1.0)
+    parser.add_argument("--print-duration", type=int, default=3600)
+    parser.add_argument("--layers", type=int, default=200)
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
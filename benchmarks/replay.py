@@ -0,0 +1,171 @@
+# coding=utf-8
+"""
+Replay a trace recorded by the plugin against a fake printer and publisher.
+
+    python -m benchmarks.replay trace-20240101-120000.jsonl --speed max
+
+With --speed max the trace runs on simulated time as fast as possible, any
+other value is a factor of real time (1 replays at the recorded pace).
+Requires OctoPrint to be installed in the same environment as the plugin.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import sys
+import time
+
+from octoprint_homeassistant.trace import (
+    TRACE_EVENT,
+    TRACE_MESSAGE,
+    TRACE_PROGRESS,
+    read_trace,
+)
+
+from .fakes import (
+    FakeClock,
+    FakeMqtt,
+    FakePrinter,
+    make_plugin,
+    remove_plugin,
+    simulated_time,
+)
+
+try:
+    from time import perf_counter, process_time
+except ImportError:
+    from time import clock as process_time
+    from time import time as perf_counter
+
+
+def apply_event(printer, event, payload):
+    """Keep the fake printer's state in line with the recorded events."""
+    from octoprint.events import Events
+
+    if event == Events.PRINT_STARTED:
+        printer.start()
+    elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+        printer.finish()
+    elif event == Events.PRINT_PAUSED:
+        printer.state = "Paused"
+    elif event == Events.PRINT_RESUMED:
+        printer.state = "Printing"
+    elif event == Events.Z_CHANGE and payload:
+        printer.current_z = payload.get("new")
+
+
+def replay(path, speed=None, settings=None):
+    """Replay the trace at path, speed None replays it on simulated time."""
+    records = list(read_trace(path))
+    if not records:
+        return {"records": 0}
+
+    clock = FakeClock(records[0][0]) if speed is None else time
+    mqtt = FakeMqtt(clock=clock)
+    printer = FakePrinter()
+    plugin = make_plugin(settings=settings, mqtt=mqtt, printer=printer)
+    plugin.on_after_startup()
+    plugin._started.wait()
+    plugin._publisher.join()
+    mqtt.reset()
+
+    def dispatch(kind, fields):
+        if kind == TRACE_EVENT:
+            apply_event(printer, fields[0], fields[1])
+            plugin.on_event(fields[0], fields[1])
+        elif kind == TRACE_PROGRESS:
+            printer.set_progress(fields[2])
+            plugin.on_print_progress(*fields)
+        elif kind == TRACE_MESSAGE:
+            control, message, retained = fields
+            mqtt.deliver(
+                plugin._generate_topic("controlTopic", control, full=True),
+                message.encode("utf-8"),
+                retained=retained,
+            )
+
+    cpu_start = process_time()
+    wall_start = perf_counter()
+    try:
+        if speed is None:
+            with simulated_time(plugin, clock) as poll:
+                for timestamp, kind, fields in records:
+                    # Run the time based jobs for the time between two records
+                    while clock.time() < timestamp:
+                        clock.sleep(min(1.0, timestamp - clock.time()))
+                        poll()
+                    dispatch(kind, fields)
+                clock.sleep(60)
+                poll()
+            plugin._handler_pool.join(10)
+            plugin._command_pipeline.join(10)
+        else:
+            first = records[0][0]
+            for timestamp, kind, fields in records:
+                delay = (timestamp - first) / speed - (perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+                dispatch(kind, fields)
+            time.sleep(plugin._settings.get_float(["status_coalesce_window"]) + 0.5)
+            plugin._handler_pool.join(10)
+            plugin._command_pipeline.join(10)
+            plugin._publisher.join(10)
+
+        topics = {}
+        for _, topic, size, _ in mqtt.messages:
+            topic_class = plugin._classify_topic(topic)
+            counts = topics.setdefault(topic_class, {"messages": 0, "bytes": 0})
+            counts["messages"] += 1
+            counts["bytes"] += size
+
+        return dict(
+            records=len(records),
+            traced_seconds=records[-1][0] - records[0][0],
+            wall_seconds=perf_counter() - wall_start,
+            cpu_seconds=process_time() - cpu_start,
+            topics=topics,
+            commands=len(printer.commands_sent),
+            **mqtt.stats()
+        )
+    finally:
+        remove_plugin(plugin)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="Trace file recorded by the plugin")
+    parser.add_argument(
+        "--speed",
+        default="max",
+        help="Replay speed as a factor of real time, or max (default)",
+    )
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override a plugin setting, the value is parsed as JSON",
+    )
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args(argv)
+
+    settings = {}
+    for setting in args.setting:
+        key, _, value = setting.partition("=")
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+
+    speed = None if args.speed == "max" else float(args.speed)
+    results = replay(args.trace, speed=speed, settings=settings)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,19 +2,45 @@
 from __future__ import absolute_import
 
 import datetime
+import functools
 import json
 import logging
 import os
+import random
 import re
 import threading
 import time
 
-import psutil
+import flask
 import octoprint.plugin
+from octoprint.access.permissions import Permissions
 from octoprint.events import Events, eventManager
-from octoprint.server import user_permission
 from octoprint.settings import settings
-from octoprint.util import RepeatedTimer
+
+from .camera import CameraBudget, CaptureForwarder, SnapshotService
+from .commands import CommandPipeline, parse_commands
+from .entities import (
+    CONTROLS,
+    FEATURE_HEATED_CHAMBER,
+    FEATURE_METRICS,
+    FEATURE_PSUCONTROL,
+    FEATURE_SNAPSHOT,
+    EntityContext,
+    available,
+    compile_entities,
+    entity_names,
+    status_paths,
+)
+from .inbound import InboundFilter
+from .ledger import DiscoveryLedger
+from .metrics import Metrics
+from .outbox import Outbox
+from .publisher import Publisher
+from .scheduler import Scheduler, TokenBucket
+from .status import CoalescingTrigger, StatusProjection, StatusTracker
+from .thermal import SocTemperatureReader
+from .trace import TRACE_EVENT, TRACE_MESSAGE, TRACE_PROGRESS, TraceRecorder, trace_path
+from .workers import POLICY_COALESCE, POLICY_QUEUE, HandlerPool
 
 SETTINGS_DEFAULTS = dict(
     unique_id=None,
@@ -23,8 +49,42 @@ SETTINGS_DEFAULTS = dict(
     node_name="OctoPrint",
     device_manufacturer="Clifford Roche",
     device_model="HomeAssistant Discovery for OctoPrint",
+    device_discovery=False,
+    discovery_jitter=30,
+    discovery_rate=5,
+    disabled_entities=[],
+    status_field_topics=False,
+    status_time_resolution=60,
+    status_coalesce_window=1.0,
+    snapshot_cache_ttl=2,
+    snapshot_max_size_kb=2048,
+    snapshot_max_dimension=0,
+    snapshot_quality=80,
+    capture_min_interval=10,
+    camera_budget_kb=0,
+    command_window=0.25,
+    command_rate=20,
+    interval_status_printing=60,
+    interval_status_idle=300,
+    interval_soc_printing=30,
+    interval_soc_idle=60,
+    interval_backoff_max=600,
+    metrics_enabled=False,
+    interval_diagnostics=300,
+    trace_enabled=False,
+    outbox_max_kb=256,
+    outbox_persist=True,
 )
 
+# Publisher keys of flushing the outbox, publishing the current state and saving the
+# discovery ledger, not topics
+_FLUSH_OUTBOX = "flush outbox"
+_CURRENT_STATE = "current state"
+_SAVE_LEDGER = "save ledger"
+# Prefixes the publisher key of a migration message, which precedes a config and
+# the empty message on the same topic
+_MIGRATE = "migrate "
+
 MQTT_DEFAULTS = dict(
     publish=dict(
         baseTopic="octoPrint/",
@@ -42,17 +102,56 @@ class HomeassistantPlugin(
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.ProgressPlugin,
     octoprint.plugin.WizardPlugin,
+    octoprint.plugin.SimpleApiPlugin,
 ):
     def __init__(self):
         self._logger = logging.getLogger(__name__)
         self.mqtt_publish = None
-        self.mqtt_publish_with_timestamp = None
-        self.mqtt_subcribe = None
-        self.update_timer = None
-        self.constant_timer = None
+        self.mqtt_unsubscribe = None
+        self.mqtt_subscribe = None
+        self._scheduler = Scheduler()
+        self._broker_failures = 0
+        # Own connected messages that weren't received back yet
+        self._connected_echoes = 0
+        self._connected_lock = threading.Lock()
+        self._ha_online = None
+        self._ha_status_topic = None
+        self._topic_table = None
+        self._discovery_ledger = None
+        self._outbox = None
+        self._publisher = Publisher()
+        # Paces discovery publishes without blocking the thread that registers
+        self._discovery_publisher = Publisher(name="HomeAssistantDiscovery")
+        self._status_lock = threading.Lock()
+        self._registration_lock = threading.Lock()
+        self._registration_timer = None
+        self._registration_force = False
+        self._discovery_bucket = TokenBucket(0)
+        self._device_components = None
+        self._compiled_entities = None
+        self._status_projection = None
+        self._status_tracker = StatusTracker()
+        self._status_trigger = CoalescingTrigger(self._generate_printer_status)
+        self._handler_pool = HandlerPool(workers=2, max_pending=16)
+        self._snapshot_service = None
+        self._camera_budget = CameraBudget()
+        self._capture_forwarder = CaptureForwarder(self._publish_camera)
+        self._soc_temperature = None
+        self._command_pipeline = None
+        self._inbound_filter = InboundFilter()
+        # The topic and callback each control is subscribed with
+        self._control_subscriptions = {}
+        self._metrics = Metrics()
+        self._trace_recorder = None
+        self.psucontrol_enabled = False
+        self.snapshot_enabled = False
+        self._startup_thread = None
+        self._started = threading.Event()
+        self._stopping = threading.Event()
 
     def handle_timer(self):
         self._generate_printer_status()
@@ -60,6 +159,92 @@ class HomeassistantPlugin(
     def handle_constant_timer(self):
         self._generate_status()
 
+    def _get_interval(self, job):
+        if job == "broker":
+            # Probes the broker while it can't be reached and the SoC temperature,
+            # which otherwise does, isn't published. At the SoC temperature's pace.
+            if not self._broker_failures or self._get_interval("soc"):
+                return None
+            job = "soc"
+
+        # The SoC temperature is only used by its own entity
+        elif job == "soc" and "SOC" in (
+            self._settings.get(["disabled_entities"]) or []
+        ):
+            return None
+
+        # Nobody is listening while Home Assistant is away. The status isn't built
+        # while the broker is away either, the SoC temperature keeps probing it.
+        elif self._ha_online is False:
+            return None
+        elif job == "status" and self._broker_failures:
+            return None
+
+        _state = "printing" if self._printer.is_printing() else "idle"
+        _interval = self._settings.get_float(["interval_" + job + "_" + _state])
+
+        # Back off while the broker can't be reached
+        if _interval and self._broker_failures:
+            _interval = min(
+                _interval * 2 ** self._broker_failures,
+                max(_interval, self._settings.get_float(["interval_backoff_max"])),
+            )
+        return _interval
+
+    def _set_broker_state(self, connected):
+        # Returns True when the broker is reachable again
+        if connected:
+            if self._broker_failures:
+                self._logger.info("MQTT broker reachable again")
+                self._broker_failures = 0
+                self._scheduler.reschedule()
+                self._publish_current_state()
+                return True
+        elif self._broker_failures < 10:
+            self._broker_failures += 1
+            if self._broker_failures == 1:
+                self._logger.info("MQTT broker unreachable, suspending status updates")
+                self._scheduler.reschedule()
+        return False
+
+    def _set_ha_state(self, online, publish=True):
+        if online == self._ha_online:
+            return
+        _was_offline = self._ha_online is False
+        self._ha_online = online
+        self._scheduler.reschedule()
+        if online:
+            if _was_offline:
+                self._logger.info("Home Assistant is back online")
+                if publish:
+                    self._publish_current_state()
+        else:
+            self._logger.info("Home Assistant went offline, suspending status updates")
+
+    def _link_up(self):
+        return not self._broker_failures and self._ha_online is not False
+
+    def _publish_current_state(self):
+        # One consolidated publish of the current state after the broker or Home
+        # Assistant were away, instead of everything that happened in the meantime
+        if not self.mqtt_publish:
+            return
+        self._status_tracker.reset()
+        self._generate_printer_status()
+        self._generate_connection_status()
+        self._publish(
+            self._generate_topic("hassTopic", "is_printing", full=True),
+            str(self._printer.is_printing()),
+        )
+        self._publish(
+            self._generate_topic("hassTopic", "is_paused", full=True),
+            str(self._printer.is_paused()),
+        )
+        self._generate_psu_state()
+        self._generate_status()
+        # After the current state, which replaces what the outbox kept of it
+        self._flush_outbox()
+
     ##~~ SettingsPlugin
 
     def get_settings_defaults(self):
@@ -77,51 +262,199 @@ class HomeassistantPlugin(
 
     def on_settings_save(self, data):
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
-
-        self._generate_device_registration()
-        self._generate_device_controls(subscribe=True)
+        self._build_topic_table()
+        if not self._started.is_set():
+            # Startup applies the settings once it gets to them
+            return
+
+        self._status_tracker.reset()
+        self._status_trigger.window = self._settings.get_float(
+            ["status_coalesce_window"]
+        )
+        self._configure_snapshot_service()
+        self._configure_command_pipeline()
+        self._metrics.enabled = self._settings.get_boolean(["metrics_enabled"])
+        self._configure_trace()
+        self._discovery_bucket.rate = self._settings.get_float(["discovery_rate"])
+        self._subscribe_ha_status()
+        self._scheduler.reschedule()
+        if self._outbox:
+            self._outbox.max_bytes = self._settings.get_int(["outbox_max_kb"]) * 1024
+
+        self._register_discovery(subscribe=True)
         self._generate_connection_status()
+        self._generate_printer_status()
 
     ##~~ TemplatePlugin mixin
 
     def get_template_configs(self):
         return [dict(type="settings", custom_bindings=False)]
 
+    def get_template_vars(self):
+        _profile = self._printer_profile_manager.get_current_or_default()
+        return dict(entities=entity_names(_profile["extruder"]["count"]))
+
     ##~~ StartupPlugin mixin
 
     def on_after_startup(self):
-        if self._settings.get(["unique_id"]) is None:
-            import uuid
+        # Only what is needed to handle events, the rest would hold up OctoPrint's
+        # startup and is done in the background
+        self._status_trigger.window = self._settings.get_float(
+            ["status_coalesce_window"]
+        )
+        self._metrics.enabled = self._settings.get_boolean(["metrics_enabled"])
 
-            _uuid = uuid.uuid4()
-            _uid = str(_uuid)
-            self._settings.set(["unique_id"], _uid)
-            self._settings.set(["node_id"], _uuid.hex)
-            settings().save()
+        self._command_pipeline = CommandPipeline(self._printer)
+        self._configure_command_pipeline()
 
-        helpers = self._plugin_manager.get_helpers(
-            "mqtt", "mqtt_publish", "mqtt_publish_with_timestamp", "mqtt_subscribe"
+        self._setup_psu_helpers()
+
+        # Camera support
+        self.snapshot_enabled = self._settings.global_get(
+            ["webcam", "timelapseEnabled"]
         )
-        if helpers:
-            if "mqtt_publish_with_timestamp" in helpers:
-                self._logger.debug("Setup publish with timestamp helper")
-                self.mqtt_publish_with_timestamp = helpers[
-                    "mqtt_publish_with_timestamp"
-                ]
-
-            if "mqtt_publish" in helpers:
-                self._logger.debug("Setup publish helper")
-                self.mqtt_publish = helpers["mqtt_publish"]
-
-            if "mqtt_subscribe" in helpers:
-                self._logger.debug("Setup subscribe helper")
-                self.mqtt_subscribe = helpers["mqtt_subscribe"]
-                self.mqtt_subscribe(
-                    self._generate_topic("lwTopic", "", full=True),
-                    self._on_mqtt_message,
+        if self.snapshot_enabled:
+            self.snapshot_path = self._settings.global_get(["webcam", "snapshot"])
+            if not self.snapshot_path:
+                self.snapshot_enabled = False
+
+        self._startup_thread = threading.Thread(
+            target=self._startup, name="HomeAssistant startup"
+        )
+        self._startup_thread.daemon = True
+        self._startup_thread.start()
+
+    def _startup(self):
+        try:
+            if self._settings.get(["unique_id"]) is None:
+                import uuid
+
+                _uuid = uuid.uuid4()
+                _uid = str(_uuid)
+                self._settings.set(["unique_id"], _uid)
+                self._settings.set(["node_id"], _uuid.hex)
+                settings().save()
+
+            self._configure_trace()
+            self._discovery_bucket.rate = self._settings.get_float(["discovery_rate"])
+            if self.snapshot_enabled:
+                self._snapshot_service = SnapshotService(self.snapshot_path)
+            self._configure_snapshot_service()
+
+            # Find the SoC temperature sensor once, instead of scanning sysfs for every sample
+            self._soc_temperature = SocTemperatureReader()
+
+            self._discovery_ledger = DiscoveryLedger(
+                os.path.join(self.get_plugin_data_folder(), "discovery_ledger.json")
+            )
+            self._outbox = Outbox(
+                os.path.join(self.get_plugin_data_folder(), "outbox.json")
+                if self._settings.get_boolean(["outbox_persist"])
+                else None,
+                max_bytes=self._settings.get_int(["outbox_max_kb"]) * 1024,
+            )
+
+            # The MQTT plugin may not have set up its helpers yet
+            _delay = 1
+            while not self._setup_mqtt_helpers():
+                if _delay > 32:
+                    self._logger.error("MQTT helpers not found, is MQTT installed?")
+                    return
+                self._logger.info(
+                    "MQTT helpers not found, retrying in " + str(_delay) + "s"
                 )
+                if self._stopping.wait(_delay):
+                    return
+                _delay *= 2
+
+            # Since retain may not be used it's not always possible to simply tie this to the connected state
+            self._register_discovery(subscribe=True)
+
+            # For people who do not have retain setup, need to do this again to make sensors available
+            self._publish_connected()
+
+            # Setup the default printer states
+            self._publish(
+                self._generate_topic("hassTopic", "is_printing", full=True),
+                "False",
+            )
+            self._publish(
+                self._generate_topic("hassTopic", "is_paused", full=True),
+                "False",
+            )
+            self._generate_printer_status()
+            self._generate_connection_status()
+            # What was pending at the last shutdown, unless it was replaced above
+            self._flush_outbox()
+
+            self._scheduler.add(
+                "status",
+                self._metrics.wrap("timer.status", self.handle_timer),
+                lambda: self._get_interval("status"),
+            )
+            self._scheduler.add(
+                "soc",
+                self._metrics.wrap("timer.soc", self.handle_constant_timer),
+                lambda: self._get_interval("soc"),
+            )
+            self._scheduler.add(
+                "broker",
+                self._metrics.wrap("timer.broker", self._probe_broker),
+                lambda: self._get_interval("broker"),
+            )
+            self._scheduler.add(
+                "diagnostics",
+                self._generate_diagnostics,
+                lambda: self._metrics.enabled
+                and self._settings.get_float(["interval_diagnostics"]),
+            )
+            if not self._stopping.is_set():
+                self._scheduler.start()
+        except Exception:
+            self._logger.exception("Unable to start the Home Assistant integration")
+        finally:
+            self._started.set()
+
+    def _setup_mqtt_helpers(self):
+        helpers = self._plugin_manager.get_helpers(
+            "mqtt", "mqtt_publish", "mqtt_subscribe", "mqtt_unsubscribe"
+        )
+        if not helpers:
+            return False
+
+        if "mqtt_publish" in helpers:
+            self._logger.debug("Setup publish helper")
+            self.mqtt_publish = self._metrics.wrap_publish(
+                helpers["mqtt_publish"], self._classify_topic
+            )
+
+        if "mqtt_subscribe" in helpers:
+            self._logger.debug("Setup subscribe helper")
+            self.mqtt_subscribe = helpers["mqtt_subscribe"]
+            self.mqtt_subscribe(
+                self._generate_topic("lwTopic", "", full=True),
+                self._on_mqtt_message,
+            )
 
-        # PSUControl helpers
+        if "mqtt_unsubscribe" in helpers:
+            self.mqtt_unsubscribe = helpers["mqtt_unsubscribe"]
+
+        self._subscribe_ha_status()
+        return True
+
+    def _subscribe_ha_status(self):
+        # Home Assistant announces itself on <discovery topic>/status
+        if not self.mqtt_subscribe:
+            return
+        _topic = self._settings.get(["discovery_topic"]) + "/status"
+        if _topic == self._ha_status_topic:
+            return
+        if self._ha_status_topic and self.mqtt_unsubscribe:
+            self.mqtt_unsubscribe(self._on_ha_status, topic=self._ha_status_topic)
+        self._ha_status_topic = _topic
+        self.mqtt_subscribe(_topic, self._on_ha_status)
+
+    def _setup_psu_helpers(self):
         psu_helpers = self._plugin_manager.get_helpers(
             "psucontrol", "turn_psu_on", "turn_psu_off", "get_psu_state"
         )
@@ -161,45 +494,145 @@ class HomeassistantPlugin(
             self._logger.info("PSUControl helpers not found")
             self.psucontrol_enabled = False
 
-        # Camera support
-        self.snapshot_enabled = self._settings.global_get(
-            ["webcam", "timelapseEnabled"]
-        )
-        if self.snapshot_enabled:
-            self.snapshot_path = self._settings.global_get(["webcam", "snapshot"])
-            if not self.snapshot_path:
-                self.snapshot_enabled = False
+    ##~~ SimpleApiPlugin mixin
+
+    def is_api_protected(self):
+        return True
 
-        if not self.update_timer:
-            self.update_timer = RepeatedTimer(60, self.handle_timer, None, None, False)
+    def on_api_get(self, request):
+        if not Permissions.STATUS.can():
+            return flask.make_response("Insufficient rights", 403)
+        return flask.jsonify(self._metrics.snapshot())
+
+    ##~~ ShutdownPlugin mixin
+
+    def on_shutdown(self):
+        self._stopping.set()
+        if self._registration_timer:
+            self._registration_timer.cancel()
+        self._scheduler.stop()
+        self._status_trigger.cancel()
+        self._handler_pool.shutdown()
+        self._capture_forwarder.stop()
+        if self._command_pipeline:
+            self._command_pipeline.stop()
+        if self._snapshot_service:
+            self._snapshot_service.close()
+        if self._soc_temperature:
+            self._soc_temperature.close()
+        if self._trace_recorder:
+            self._trace_recorder.close()
+        # What is still waiting to be published ends up in the outbox
+        self._discovery_publisher.stop()
+        self._publisher.stop()
+        if self._discovery_ledger:
+            self._discovery_ledger.save()
+        if self._outbox:
+            self._outbox.close()
+
+    def _configure_snapshot_service(self):
+        _max_bytes = self._settings.get_int(["snapshot_max_size_kb"]) * 1024
+
+        self._camera_budget.bytes_per_minute = (
+            self._settings.get_int(["camera_budget_kb"]) * 1024
+        )
+        self._capture_forwarder.min_interval = self._settings.get_float(
+            ["capture_min_interval"]
+        )
+        self._capture_forwarder.max_bytes = _max_bytes
+
+        if not self._snapshot_service:
+            return
+        self._snapshot_service.configure(
+            ttl=self._settings.get_float(["snapshot_cache_ttl"]),
+            max_bytes=_max_bytes,
+            max_dimension=self._settings.get_int(["snapshot_max_dimension"]),
+            quality=self._settings.get_int(["snapshot_quality"]),
+        )
+        self._capture_forwarder.process = self._snapshot_service.process
 
-        if not self.constant_timer:
-            self.constant_timer = RepeatedTimer(
-                30, self.handle_constant_timer, None, None, False
+    def _configure_command_pipeline(self):
+        if self._command_pipeline:
+            self._command_pipeline.window = self._settings.get_float(
+                ["command_window"]
             )
-            self.constant_timer.start()
+            self._command_pipeline.rate = self._settings.get_float(["command_rate"])
+
+    def _publish_camera(self, file_content):
+        if not self.mqtt_publish:
+            return
+        _topic = self._generate_topic("baseTopic", "camera", full=True)
+
+        def publish():
+            # Only frames that were handed to the broker count against the budget
+            if not self._camera_budget.allow(len(file_content)):
+                self._logger.info("Camera budget exceeded, frame not published")
+                return
+            _published = self.mqtt_publish(
+                _topic, file_content, allow_queueing=False, raw_data=True
+            )
+            if _published is not False:
+                self._camera_budget.charge(len(file_content))
+
+        self._publisher.submit(_topic, publish)
 
-        # Since retain may not be used it's not always possible to simply tie this to the connected state
-        self._generate_device_registration()
-        self._generate_device_controls(subscribe=True)
+    def _configure_trace(self):
+        if self._settings.get_boolean(["trace_enabled"]):
+            if not self._trace_recorder:
+                self._trace_recorder = TraceRecorder(
+                    trace_path(os.path.join(self.get_plugin_data_folder(), "traces"))
+                )
+                self._logger.info("Recording trace to " + self._trace_recorder.path)
+        elif self._trace_recorder:
+            self._trace_recorder.close()
+            self._trace_recorder = None
+
+    def _publish(self, topic, payload, retained=False):
+        # All publishing happens on the publisher thread, in the order it was
+        # submitted in and only the latest payload per topic
+        if not self.mqtt_publish:
+            return False
+        return self._publisher.submit(
+            topic, functools.partial(self._publish_now, topic, payload, retained)
+        )
 
-        # For people who do not have retain setup, need to do this again to make sensors available
-        _connected_topic = self._generate_topic("lwTopic", "", full=True)
-        self.mqtt_publish(_connected_topic, "connected", allow_queueing=True)
+    def _publish_now(self, topic, payload, retained=False):
+        # The MQTT plugin queues every message while the broker is away and sends
+        # all of them once it's back. Only the latest state per topic is of use,
+        # so publish without its queue and keep what fails in the outbox.
+        if not self.mqtt_publish:
+            return False
+        if self._outbox is None:
+            return self.mqtt_publish(
+                topic, payload, retained=retained, allow_queueing=True
+            )
 
-        # Setup the default printer states
-        self.mqtt_publish(
-            self._generate_topic("hassTopic", "is_printing", full=True),
-            "False",
-            allow_queueing=True,
+        _published = self.mqtt_publish(
+            topic, payload, retained=retained, allow_queueing=False
         )
-        self.mqtt_publish(
-            self._generate_topic("hassTopic", "is_paused", full=True),
-            "False",
-            allow_queueing=True,
+        if _published is False:
+            self._outbox.put(topic, payload, retained)
+            # The scheduled jobs back off from there on
+            if not self._broker_failures:
+                self._set_broker_state(False)
+        else:
+            self._outbox.discard(topic)
+            self._set_broker_state(True)
+        return _published
+
+    def _flush_outbox(self):
+        if not self._outbox or not self.mqtt_publish:
+            return
+        self._publisher.submit(_FLUSH_OUTBOX, self._flush_outbox_now)
+
+    def _flush_outbox_now(self):
+        _published = self._outbox.flush(
+            lambda topic, payload, retained: self.mqtt_publish(
+                topic, payload, retained=retained, allow_queueing=False
+            )
         )
-        self.on_print_progress("", "", 0)
-        self._generate_connection_status()
+        if _published:
+            self._logger.info("Published " + str(_published) + " pending messages")
 
     def _get_mac_address(self):
         import uuid
@@ -211,331 +644,365 @@ class HomeassistantPlugin(
     ):
         self._logger.info("Received MQTT message from " + topic)
         self._logger.info(message)
+        if isinstance(message, bytes):
+            message = message.decode("utf-8", "replace")
 
         # Don't rely on this, the message may be disabled.
         if message == "connected":
-            self._generate_device_registration()
-            self._generate_device_controls(subscribe=False)
+            if not retained and self._connected_echo():
+                return
+            _recovered = self._set_broker_state(True)
+            self._register_discovery(subscribe=False)
+            # A retained message is a replay on subscribe, a live one means the MQTT
+            # plugin (re)connected and may have missed an outage. Either way what
+            # failed to publish in the meantime is still waiting in the outbox.
+            if not _recovered:
+                if retained:
+                    self._flush_outbox()
+                else:
+                    self._publish_current_state()
+
+    def _publish_connected(self):
+        # The connected message comes back to _on_mqtt_message, where it must not
+        # be mistaken for the MQTT plugin reconnecting
+        _topic = self._generate_topic("lwTopic", "", full=True)
+        self._publisher.submit(
+            _topic, functools.partial(self._publish_connected_now, _topic)
+        )
 
-    def _generate_topic(self, topic_type, topic, full=False):
-        self._logger.debug("Generating topic for " + topic_type + ", " + topic)
+    def _publish_connected_now(self, topic):
+        with self._connected_lock:
+            self._connected_echoes += 1
+        if self._publish_now(topic, "connected") is False:
+            with self._connected_lock:
+                self._connected_echoes -= 1
+
+    def _connected_echo(self):
+        # Whether a live connected message is one the plugin published itself
+        with self._connected_lock:
+            if not self._connected_echoes:
+                return False
+            self._connected_echoes -= 1
+            return True
+
+    def _on_ha_status(self, topic, message, retained=None, qos=None, *args, **kwargs):
+        if isinstance(message, bytes):
+            message = message.decode("utf-8", "replace")
+        self._logger.debug("Home Assistant status: " + str(message))
+        if message == "online":
+            # A retained birth message is a replay on subscribe, a live one means Home
+            # Assistant (re)started and lost the discovery configs it had. The whole
+            # fleet receives it at the same moment, spread the re-registrations.
+            if retained or not self._started.is_set():
+                self._set_ha_state(True)
+                return
+            self._set_ha_state(True, publish=False)
+            self._schedule_registration()
+        elif message == "offline":
+            self._set_ha_state(False)
+
+    def _build_topic_table(self):
         mqtt_defaults = dict(plugins=dict(mqtt=MQTT_DEFAULTS))
-        _topic = ""
+        _base_topic = settings().get(
+            ["plugins", "mqtt", "publish", "baseTopic"], defaults=mqtt_defaults
+        )
 
-        if topic_type != "baseTopic":
+        _topics = dict(baseTopic=_base_topic)
+        _full_topics = dict(baseTopic=_base_topic)
+        for topic_type in MQTT_DEFAULTS["publish"]:
+            if topic_type == "baseTopic":
+                continue
             _topic = settings().get(
                 ["plugins", "mqtt", "publish", topic_type], defaults=mqtt_defaults
             )
             _topic = re.sub(r"{.+}", "", _topic)
+            _topics[topic_type] = _topic
+            _full_topics[topic_type] = _base_topic + _topic
 
-        if full or topic_type == "baseTopic":
-            _topic = (
-                settings().get(
-                    ["plugins", "mqtt", "publish", "baseTopic"], defaults=mqtt_defaults
-                )
-                + _topic
-            )
-
-        _topic += topic
-        self._logger.debug("Generated topic: " + _topic)
-        return _topic
-
-    def _generate_device_registration(self):
-
-        _discovery_topic = self._settings.get(["discovery_topic"])
-
-        _node_name = self._settings.get(["node_name"])
-        _node_id = self._settings.get(["node_id"])
+        self._logger.debug("Resolved topic table: " + str(_full_topics))
+        # Swap both tables in one assignment, publishers on other threads may be reading it
+        self._topic_table = (_topics, _full_topics)
+        return self._topic_table
 
-        _device_manufacturer = self._settings.get(["device_manufacturer"])
-        _device_model = self._settings.get(["device_model"])
-
-        _config_device = self._generate_device_config(
-            _node_id, _node_name, _device_manufacturer, _device_model
+    def _generate_topic(self, topic_type, topic, full=False):
+        _topic_table = self._topic_table or self._build_topic_table()
+        return _topic_table[1 if full else 0][topic_type] + topic
+
+    def _classify_topic(self, topic):
+        _full_topics = (self._topic_table or self._build_topic_table())[1]
+        if topic.startswith(_full_topics["hassTopic"]):
+            return "hassTopic"
+        if topic.startswith(_full_topics["temperatureTopic"]):
+            return "temperature"
+        if topic == _full_topics["baseTopic"] + "camera":
+            return "camera"
+        if topic.startswith(self._settings.get(["discovery_topic"]) + "/"):
+            return "discovery"
+        return "other"
+
+    def _schedule_registration(self):
+        _delay = random.uniform(0, self._settings.get_float(["discovery_jitter"]))
+        self._logger.info(
+            "Registering with Home Assistant again in " + str(round(_delay, 1)) + "s"
         )
 
-        ##~~ Configure Connected Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/binary_sensor/" + _node_id + "_CONNECTED/config",
-            values={
-                "name": _node_name + " Connected",
-                "uniq_id": _node_id + "_CONNECTED",
-                "stat_t": "~" + self._generate_topic("hassTopic", "Connected"),
-                "pl_on": "Connected",
-                "pl_off": "Disconnected",
-                "dev_cla": "connectivity",
-                "device": _config_device,
-            },
-        )
+        if self._registration_timer:
+            self._registration_timer.cancel()
+        self._registration_timer = threading.Timer(_delay, self._reregister)
+        self._registration_timer.name = "HomeAssistantRegistration"
+        self._registration_timer.daemon = True
+        self._registration_timer.start()
 
-        ##~~ Configure Printing Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/binary_sensor/" + _node_id + "_PRINTING/config",
-            values={
-                "name": _node_name + " Printing",
-                "uniq_id": _node_id + "_PRINTING",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "pl_on": "True",
-                "pl_off": "False",
-                "val_tpl": "{{value_json.state.flags.printing}}",
-                "device": _config_device,
-            },
-        )
+    def _reregister(self):
+        if self._stopping.is_set():
+            return
+        try:
+            self._register_discovery(force=True)
+            # Once the paced discovery configs were handed to the publisher
+            self._discovery_publisher.submit(
+                _CURRENT_STATE, self._publish_current_state
+            )
+        except Exception as e:
+            self._logger.error("Unable to register with Home Assistant: " + str(e))
 
-        ##~~ Configure Last Event Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_EVENT/config",
-            values={
-                "name": _node_name + " Last Event",
-                "uniq_id": _node_id + "_EVENT",
-                "stat_t": "~" + self._generate_topic("eventTopic", "+"),
-                "val_tpl": "{{value_json._event}}",
-                "device": _config_device,
-            },
+    def _publish_discovery(
+        self, topic, payload, retained=False, payload_hash=None, key=None
+    ):
+        _key = key or topic
+        _operation = functools.partial(
+            self._pace_discovery, _key, topic, payload, retained, payload_hash
         )
-
-        ##~~ Configure Print Status
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_S/config",
-            values={
-                "name": _node_name + " Print Status",
-                "uniq_id": _node_id + "_PRINTING_S",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.state|tojson}}",
-                "val_tpl": "{{value_json.state.text}}",
-                "device": _config_device,
-            },
+        if not self._discovery_bucket.rate:
+            _operation()
+            return
+        # Paced on the discovery publisher's thread, a fleet re-registering at once
+        # would flood the broker and Home Assistant
+        self._discovery_publisher.submit(_key, _operation)
+
+    def _pace_discovery(self, key, topic, payload, retained, payload_hash):
+        while not self._discovery_bucket.take():
+            if self._stopping.wait(self._discovery_bucket.delay()):
+                return
+        self._publisher.submit(
+            key,
+            functools.partial(
+                self._publish_discovery_now, topic, payload, retained, payload_hash
+            ),
         )
 
-        ##~~ Configure Print Progress
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_P/config",
-            values={
-                "name": _node_name + " Print Progress",
-                "uniq_id": _node_id + "_PRINTING_P",
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.progress|tojson}}",
-                "stat_t": "~" + self._generate_topic("progressTopic", "printing"),
-                "unit_of_meas": "%",
-                "val_tpl": "{{value_json.progress|float|default(0,true)}}",
-                "device": _config_device,
-            },
-        )
+    def _publish_discovery_now(self, topic, payload, retained, payload_hash):
+        # The ledger only records what was published, a config that failed is
+        # published again by the next registration
+        _published = self._publish_now(topic, payload, retained) is not False
+        if not payload_hash:
+            return
+        if _published:
+            self._discovery_ledger.commit(topic, payload_hash)
+        else:
+            self._discovery_ledger.release(topic, payload_hash)
 
-        ##~~ Configure Print File
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_F/config",
-            values={
-                "name": _node_name + " Print File",
-                "uniq_id": _node_id + "_PRINTING_F",
-                "stat_t": "~" + self._generate_topic("progressTopic", "printing"),
-                "val_tpl": "{{value_json.path}}",
-                "device": _config_device,
-                "ic": "mdi:file",
-            },
+    def _save_discovery_ledger(self):
+        # Once the configs submitted before were published, in one write instead of
+        # one per config
+        _operation = functools.partial(
+            self._publisher.submit, _SAVE_LEDGER, self._discovery_ledger.save
         )
+        if not self._discovery_bucket.rate:
+            _operation()
+            return
+        self._discovery_publisher.submit(_SAVE_LEDGER, _operation)
+
+    def _register_discovery(self, subscribe=False, force=False):
+        # Without the MQTT helpers nothing can be published, and the ledger must not
+        # record it as if it was
+        if not self.mqtt_publish or not self._discovery_ledger:
+            return
+        with self._registration_lock:
+            self._registration_force = force
+            self._discovery_ledger.begin()
+            try:
+                _context = self._entity_context()
+                self._status_projection = StatusProjection(status_paths(_context))
+                self._migrate_discovery(_context)
+                if self._settings.get_boolean(["device_discovery"]):
+                    self._device_components = {}
+                    try:
+                        self._generate_device_registration(_context)
+                        self._generate_device_discovery(self._device_components)
+                    finally:
+                        self._device_components = None
+                else:
+                    self._generate_device_registration(_context)
+                if subscribe and self.mqtt_subscribe:
+                    self._subscribe_controls(_context)
+            finally:
+                self._registration_force = False
+                _stale_topics = self._discovery_ledger.finish()
+
+            # Entities that are no longer generated are removed by clearing their retained config
+            for _topic in _stale_topics:
+                self._logger.info("Removing discovery config " + _topic)
+                self._publish_discovery(_topic, "", retained=True)
+            self._save_discovery_ledger()
+
+    def _migrate_discovery(self, context):
+        # Home Assistant ignores an entity whose unique id was discovered on another
+        # topic. When switching between device based and per entity discovery the
+        # old configs hand their entities over first, are replaced by the new ones
+        # and are cleared as stale topics afterwards.
+        _device_topic = self._device_discovery_topic()
+        if self._settings.get_boolean(["device_discovery"]):
+            _topics = [
+                _topic
+                for _, _topic, _ in self._compile_entities(context)
+                if self._discovery_ledger.published(_topic)
+            ]
+        elif self._discovery_ledger.published(_device_topic):
+            _topics = [_device_topic]
+        else:
+            return
+
+        for _topic in _topics:
+            self._logger.info("Migrating discovery config " + _topic)
+            self._publish_discovery(
+                _topic,
+                {"migrate_discovery": True},
+                retained=True,
+                key=_MIGRATE + _topic,
+            )
 
-        ##~~ Configure Print Time
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_T/config",
-            values={
-                "name": _node_name + " Print Time",
-                "uniq_id": _node_id + "_PRINTING_T",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "val_tpl": "{{value_json.progress.printTimeFormatted}}",
-                "device": _config_device,
-                "ic": "mdi:clock-start",
-            },
-        )
+    def _update_profile_entities(self):
+        # Only the tool and chamber entities depend on the printer profile, publish the
+        # ones that were added and clear the ones that were removed instead of
+        # registering everything again
+        if self._compiled_entities is None:
+            return
+        with self._registration_lock:
+            _previous, _compiled = self._compiled_entities
+            _context = self._entity_context()
+            if _context == _previous:
+                return
+            _full = self._settings.get_boolean(["device_discovery"]) or (
+                _context._replace(tools=_previous.tools, features=_previous.features)
+                != _previous
+            )
+            if not _full:
+                _entities = self._compile_entities(_context)
+                self._status_projection = StatusProjection(status_paths(_context))
+
+                _previous_topics = set(_topic for _, _topic, _ in _compiled)
+                _topics = set(_topic for _, _topic, _ in _entities)
+                _added = [e for e in _entities if e[1] not in _previous_topics]
+                _removed = [t for _, t, _ in _compiled if t not in _topics]
+                self._logger.info(
+                    "Printer profile changed, adding "
+                    + str(len(_added))
+                    + " and removing "
+                    + str(len(_removed))
+                    + " entities"
+                )
 
-        ##~~ Configure Print Time Left
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_E/config",
-            values={
-                "name": _node_name + " Print Time Left",
-                "uniq_id": _node_id + "_PRINTING_E",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "val_tpl": "{{value_json.progress.printTimeLeftFormatted}}",
-                "device": _config_device,
-                "ic": "mdi:clock-end",
-            },
-        )
+                for _suffix, _topic, _values in _added:
+                    self._generate_sensor(topic=_topic, values=_values)
+                for _topic in _removed:
+                    self._discovery_ledger.remove(_topic)
+                    self._publish_discovery(_topic, "", retained=True)
+                self._save_discovery_ledger()
+                return
 
-        ##~~ Configure Print ETA
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_ETA/config",
-            values={
-                "name": _node_name + " Print Estimated Time",
-                "uniq_id": _node_id + "_PRINTING_ETA",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.job|tojson}}",
-                "val_tpl": "{{value_json.job.estimatedPrintTimeFormatted}}",
-                "device": _config_device,
-            },
-        )
+        # Device based discovery has all entities in one message
+        self._logger.info("Printer profile changed, registering again")
+        self._register_discovery()
 
-        ##~~ Configure Print Current Z
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_Z/config",
-            values={
-                "name": _node_name + " Current Z",
-                "uniq_id": _node_id + "_PRINTING_Z",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "unit_of_meas": "mm",
-                "val_tpl": "{{value_json.currentZ|float}}",
-                "device": _config_device,
-                "ic": "mdi:axis-z-arrow",
-            },
-        )
+    def _entity_context(self):
+        _profile = self._printer_profile_manager.get_current_or_default()
+        _node_id = self._settings.get(["node_id"])
+        _node_name = self._settings.get(["node_name"])
 
-        ##~~ Configure Slicing Status
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_SLICING_P/config",
-            values={
-                "name": _node_name + " Slicing Progress",
-                "uniq_id": _node_id + "_SLICING_P",
-                "stat_t": "~" + self._generate_topic("progressTopic", "slicing"),
-                "unit_of_meas": "%",
-                "val_tpl": "{{value_json.progress|float|default(0,true)}}",
-                "device": _config_device,
-            },
+        _features = set()
+        if _profile["heatedChamber"]:
+            _features.add(FEATURE_HEATED_CHAMBER)
+        if self.psucontrol_enabled:
+            _features.add(FEATURE_PSUCONTROL)
+        if self.snapshot_enabled:
+            _features.add(FEATURE_SNAPSHOT)
+        if self._settings.get_boolean(["metrics_enabled"]):
+            _features.add(FEATURE_METRICS)
+
+        return EntityContext(
+            discovery_topic=self._settings.get(["discovery_topic"]),
+            node_id=_node_id,
+            node_name=_node_name,
+            device=self._generate_device_config(
+                _node_id,
+                _node_name,
+                self._settings.get(["device_manufacturer"]),
+                self._settings.get(["device_model"]),
+            ),
+            topics=(self._topic_table or self._build_topic_table())[0],
+            status_field_topics=self._settings.get_boolean(["status_field_topics"]),
+            tools=_profile["extruder"]["count"],
+            features=frozenset(_features),
+            disabled=frozenset(self._settings.get(["disabled_entities"]) or []),
         )
 
-        ##~~ Configure Slicing File
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_SLICING_F/config",
-            values={
-                "name": _node_name + " Slicing File",
-                "uniq_id": _node_id + "_SLICING_F",
-                "stat_t": "~" + self._generate_topic("progressTopic", "slicing"),
-                "val_tpl": "{{value_json.source_path}}",
-                "device": _config_device,
-                "ic": "mdi:file",
-            },
+    def _compile_entities(self, context):
+        # Payloads only change with the settings and the printer profile
+        if self._compiled_entities is None or self._compiled_entities[0] != context:
+            self._compiled_entities = (context, compile_entities(context))
+        return self._compiled_entities[1]
+
+    def _generate_device_registration(self, context):
+        for _suffix, _topic, _values in self._compile_entities(context):
+            self._generate_sensor(topic=_topic, values=_values)
+
+    def _device_discovery_topic(self):
+        return (
+            self._settings.get(["discovery_topic"])
+            + "/device/"
+            + self._settings.get(["node_id"])
+            + "/config"
         )
 
-        ##~~ Tool Temperature
-        _e = self._printer_profile_manager.get_current_or_default()["extruder"]["count"]
-        for x in range(_e):
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_TOOL"
-                + str(x)
-                + "/config",
-                values={
-                    "name": _node_name + " Tool " + str(x) + " Temperature",
-                    "uniq_id": _node_id + "_TOOL" + str(x),
-                    "stat_t": "~"
-                    + self._generate_topic("temperatureTopic", "tool" + str(x)),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.actual|float}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:printer-3d-nozzle",
-                },
-            )
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_TOOL"
-                + str(x)
-                + "_TARGET"
-                + "/config",
-                values={
-                    "name": _node_name + " Tool " + str(x) + " Target",
-                    "uniq_id": _node_id + "_TOOL" + str(x) + "_TARGET",
-                    "stat_t": "~"
-                    + self._generate_topic("temperatureTopic", "tool" + str(x)),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.target|float}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:printer-3d-nozzle",
-                },
-            )
+    def _generate_device_discovery(self, components):
+        _node_id = self._settings.get(["node_id"])
 
-        ##~~ Bed Temperature
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_BED/config",
-            values={
-                "name": _node_name + " Bed Temperature",
-                "uniq_id": _node_id + "_BED",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "bed"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.actual|float}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
-            },
-        )
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_BED_TARGET/config",
-            values={
-                "name": _node_name + " Bed Target",
-                "uniq_id": _node_id + "_BED_TARGET",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "bed"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.target|float}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
-            },
+        _config_device = self._generate_device_config(
+            _node_id,
+            self._settings.get(["node_name"]),
+            self._settings.get(["device_manufacturer"]),
+            self._settings.get(["device_model"]),
         )
 
-        ##~~ Chamber Temperature
-        _h = self._printer_profile_manager.get_current_or_default()["heatedChamber"]
-        if _h:
-            self._generate_sensor(
-                topic=_discovery_topic + "/sensor/" + _node_id + "_CHAMBER/config",
-                values={
-                    "name": _node_name + " Chamber Temperature",
-                    "uniq_id": _node_id + "_CHAMBER",
-                    "stat_t": "~" + self._generate_topic("temperatureTopic", "chamber"),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.actual|float}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:radiator",
-                },
-            )
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_CHAMBER_TARGET/config",
-                values={
-                    "name": _node_name + " Chamber Target",
-                    "uniq_id": _node_id + "_CHAMBER_TARGET",
-                    "stat_t": "~" + self._generate_topic("temperatureTopic", "chamber"),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.target|float}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:radiator",
-                },
-            )
-
-        ##~~ SoC Temperature (if supported)
-        self._generate_sensor(
-            topic="homeassistant/sensor/" + _node_id + "_SOC/config",
-            values={
-                "name": _node_name + " SoC Temperature",
-                "uniq_id": _node_id + "_SOC",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "soc"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.temperature|float|round(1)}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
+        # Availability is shared by all components unless a component defines its own
+        payload = {
+            "dev": _config_device,
+            "o": {
+                "name": "OctoPrint-HomeAssistant",
+                "sw": self._plugin_version,
+                "url": "https://github.com/cmroche/OctoPrint-HomeAssistant",
             },
-        )
+            "avty_t": "~" + self._generate_topic("lwTopic", ""),
+            "pl_avail": "connected",
+            "pl_not_avail": "disconnected",
+            "~": self._generate_topic("baseTopic", "", full=True),
+            "cmps": components,
+        }
+
+        topic = self._device_discovery_topic()
+        _hash = self._discovery_ledger.update(topic, payload, self._registration_force)
+        if _hash:
+            self._publish_discovery(topic, payload, payload_hash=_hash)
 
     def _generate_sensor(self, topic, values):
+        if self._device_components is not None:
+            # Device based discovery, components are published together in one message
+            _component = dict(values)
+            _component.pop("device", None)
+            _component["p"] = topic.split("/")[-3]
+            self._device_components[values["uniq_id"]] = _component
+            return
+
         payload = {
             "avty_t": "~" + self._generate_topic("lwTopic", ""),
             "pl_avail": "connected",
@@ -543,7 +1010,9 @@ class HomeassistantPlugin(
             "~": self._generate_topic("baseTopic", "", full=True),
         }
         payload.update(values)
-        self.mqtt_publish(topic, payload, allow_queueing=True)
+        _hash = self._discovery_ledger.update(topic, payload, self._registration_force)
+        if _hash:
+            self._publish_discovery(topic, payload, payload_hash=_hash)
 
     def _generate_device_config(
         self, _node_id, _node_name, _device_manufacturer, _device_model
@@ -558,68 +1027,136 @@ class HomeassistantPlugin(
         return _config_device
 
     def _get_cpu_temp(self):
-        if hasattr(psutil, "sensors_temperatures"):
-            temps = psutil.sensors_temperatures()
-            if temps:
-                if "coretemp" in temps:
-                    return temps["coretemp"][0].current
-                if "cpu-thermal" in temps:
-                    return temps["cpu-thermal"][0].current
-                if "cpu_thermal" in temps:
-                    return temps["cpu_thermal"][0].current
-        return None
+        if self._soc_temperature is None:
+            self._soc_temperature = SocTemperatureReader()
+        return self._soc_temperature.read()
 
     def _generate_status(self):
 
-        data = {"temperature": self._get_cpu_temp()}
+        if not self.mqtt_publish:
+            return
+
+        _topic = self._generate_topic("temperatureTopic", "soc", full=True)
+        data = {"temperature": self._get_cpu_temp(), "_timestamp": int(time.time())}
+
+        def publish():
+            # A stale temperature is of no use, don't queue it and use the result to
+            # find out whether the broker is reachable
+            _published = self.mqtt_publish(_topic, data, allow_queueing=False)
+            self._set_broker_state(_published is not False)
+
+        self._publisher.submit(_topic, publish)
 
-        if self.mqtt_publish_with_timestamp:
-            self.mqtt_publish_with_timestamp(
-                self._generate_topic("temperatureTopic", "soc", full=True),
-                data,
-                allow_queueing=True,
+    def _probe_broker(self):
+        # The printer's connection state is always valid to publish again
+        if not self.mqtt_publish:
+            return
+
+        _topic = self._generate_topic("hassTopic", "Connected", full=True)
+        _payload = self._connection_state()
+
+        def publish():
+            _published = self.mqtt_publish(_topic, _payload, allow_queueing=False)
+            self._set_broker_state(_published is not False)
+
+        self._publisher.submit(_topic, publish)
+
+    def _generate_diagnostics(self):
+        if self.mqtt_publish:
+            _topic = self._generate_topic("hassTopic", "diagnostics", full=True)
+            self._publisher.submit(
+                _topic,
+                functools.partial(
+                    self.mqtt_publish,
+                    _topic,
+                    self._metrics.summary(),
+                    allow_queueing=False,
+                ),
             )
 
     def _generate_printer_status(self):
-
-        data = self._printer.get_current_data()
+        # Until startup has found the MQTT helpers there is nothing to publish to,
+        # the status tracker would consider the status published. The same goes
+        # for while the broker or Home Assistant are away.
+        if not self.mqtt_publish or not self._link_up():
+            return
+
+        # Called from the scheduler, event, progress and settings threads. Building
+        # and submitting the status under the lock keeps the published order the
+        # same as the order the status was read in.
+        with self._status_lock:
+            self._generate_printer_status_locked()
+
+    def _generate_printer_status_locked(self):
+        # The printer's data is not ours to change, copy what is formatted
+        data = dict(self._printer.get_current_data())
+        data["progress"] = _progress = dict(data.get("progress") or {})
+        data["job"] = _job = dict(data.get("job") or {})
         try:
-            data["progress"]["printTimeLeftFormatted"] = str(
-                datetime.timedelta(seconds=int(data["progress"]["printTimeLeft"]))
+            _progress["printTimeLeftFormatted"] = str(
+                datetime.timedelta(seconds=int(_progress["printTimeLeft"]))
             ).split(".")[0]
         except:
-            data["progress"]["printTimeLeftFormatted"] = None
+            _progress["printTimeLeftFormatted"] = None
         try:
-            data["progress"]["printTimeFormatted"] = str(
-                datetime.timedelta(seconds=data["progress"]["printTime"])
+            _progress["printTimeFormatted"] = str(
+                datetime.timedelta(seconds=_progress["printTime"])
             ).split(".")[0]
         except:
-            data["progress"]["printTimeFormatted"] = None
+            _progress["printTimeFormatted"] = None
         try:
-            data["job"]["estimatedPrintTimeFormatted"] = str(
-                datetime.timedelta(seconds=data["job"]["estimatedPrintTime"])
+            _job["estimatedPrintTimeFormatted"] = str(
+                datetime.timedelta(seconds=_job["estimatedPrintTime"])
             ).split(".")[0]
         except:
-            data["job"]["estimatedPrintTimeFormatted"] = None
-
-        if self.mqtt_publish_with_timestamp:
-            self.mqtt_publish_with_timestamp(
+            _job["estimatedPrintTimeFormatted"] = None
+
+        # Only publish what the templates of the enabled entities read, the rest of
+        # the printer data (logs, messages, offsets, file metadata) is never used
+        _projection = self._status_projection
+        _fields = None
+        if _projection is not None:
+            data = _projection.project(data)
+            _fields = _projection.fields
+
+        _field_topics = self._settings.get_boolean(["status_field_topics"])
+        _changed = self._status_tracker.update(
+            data,
+            time_resolution=self._settings.get_int(["status_time_resolution"]),
+            per_field=_field_topics,
+            fields=_fields,
+        )
+        if not _changed:
+            return
+
+        if _field_topics:
+            for field in _changed:
+                self._publish(
+                    self._generate_topic("hassTopic", "printing/" + field, full=True),
+                    data.get(field)
+                    if _projection is None
+                    else _projection.encode(data.get(field)),
+                )
+        else:
+            data["_timestamp"] = int(time.time())
+            self._publish(
                 self._generate_topic("hassTopic", "printing", full=True),
-                data,
-                allow_queueing=True,
+                data if _projection is None else _projection.encode(data),
             )
 
+    def _connection_state(self):
+        state, _, _, _ = self._printer.get_current_connection()
+        return "Disconnected" if state == "Closed" else "Connected"
+
     def _generate_connection_status(self):
 
-        state, _, _, _ = self._printer.get_current_connection()
-        state_connected = "Disconnected" if state == "Closed" else "Connected"
+        state_connected = self._connection_state()
         # Function can be called by on_event before on_after_startup has run.
         # This will throw a TypeError since self.mqtt_publish is still null.
         if self.mqtt_publish:
-            self.mqtt_publish(
+            self._publish(
                 self._generate_topic("hassTopic", "Connected", full=True),
                 state_connected,
-                allow_queueing=True,
             )
 
     def _generate_psu_state(self, psu_state=None):
@@ -630,10 +1167,9 @@ class HomeassistantPlugin(
                     "No psu_state specified, state retrieved from helper: "
                     + str(psu_state)
                 )
-            self.mqtt_publish(
+            self._publish(
                 self._generate_topic("hassTopic", "psu_state", full=True),
                 str(psu_state),
-                allow_queueing=True,
             )
 
     def _on_emergency_stop(
@@ -685,17 +1221,12 @@ class HomeassistantPlugin(
     def _on_camera(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Camera snapshot message received: " + str(message))
         if self.snapshot_enabled:
-            import urllib.request as urlreq
-
-            url_handle = urlreq.urlopen(self.snapshot_path)
-            file_content = url_handle.read()
-            url_handle.close()
-            self.mqtt_publish(
-                self._generate_topic("baseTopic", "camera", full=True),
-                file_content,
-                allow_queueing=False,
-                raw_data=True,
-            )
+            try:
+                file_content = self._snapshot_service.get()
+            except Exception as e:
+                self._logger.error("Unable to get camera snapshot: " + str(e))
+                return
+            self._publish_camera(file_content)
 
     def _on_home(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Homing printer: " + str(message))
@@ -703,7 +1234,7 @@ class HomeassistantPlugin(
             try:
                 home_payload = json.loads(message)
                 axes = set(home_payload) & set(["x", "y", "z", "e"])
-                self._printer.home(list(axes))
+                self._command_pipeline.home(list(axes))
             except Exception as e:
                 self._logger.error("Unable to run home command: " + str(e))
 
@@ -714,201 +1245,84 @@ class HomeassistantPlugin(
                 jog_payload = json.loads(message)
                 axes_keys = set(jog_payload.keys()) & set(["x", "y", "z"])
                 axes = {k: v for (k, v) in jog_payload.items() if k in axes_keys}
-                self._printer.jog(axes, jog_payload.get("speed"))
+                self._command_pipeline.jog(axes, jog_payload.get("speed"))
             except Exception as e:
                 self._logger.error("Unable to run jog command: " + str(e))
 
     def _on_command(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Jogging received gcode commands")
         try:
-            self._printer.commands(message)
+            self._command_pipeline.commands(parse_commands(message))
         except Exception as e:
             self._logger.error("Unable to run printer commands: " + str(e))
 
-    def _generate_device_controls(self, subscribe=False):
-
-        _discovery_topic = self._settings.get(["discovery_topic"])
-
-        _node_name = self._settings.get(["node_name"])
-        _node_id = self._settings.get(["node_id"])
-
-        _device_manufacturer = self._settings.get(["device_manufacturer"])
-        _device_model = self._settings.get(["device_model"])
-
-        _config_device = self._generate_device_config(
-            _node_id, _node_name, _device_manufacturer, _device_model
-        )
-
-        # Emergency stop
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "stop", full=True),
-                self._on_emergency_stop,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_STOP/config",
-            values={
-                "name": _node_name + " Emergency Stop",
-                "uniq_id": _node_id + "_STOP",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "stop"),
-                "stat_t": "~" + self._generate_topic("controlTopic", "stop"),
-                "pl_off": "False",
-                "pl_on": "True",
-                "val_tpl": "{{False}}",
-                "device": _config_device,
-                "ic": "mdi:alert-octagon",
-            },
-        )
-
-        # Cancel print
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "cancel", full=True),
-                self._on_cancel_print,
+    def _subscribe_control(self, control, handler, policy=POLICY_QUEUE, timeout=30):
+        # Every subscription gets its own callback, subscribing again would run the
+        # handler once more for every message. Only a changed topic resubscribes.
+        _topic = self._generate_topic("controlTopic", control, full=True)
+        _subscription = self._control_subscriptions.get(control)
+        if _subscription and _subscription[0] == _topic:
+            return
+        self._unsubscribe_control(control)
+
+        # Without a policy the handler runs directly on the MQTT thread
+        _callback = self._metrics.wrap("handler." + control, handler)
+        if policy is not None:
+            _callback = self._handler_pool.wrap(
+                _callback, policy=policy, timeout=timeout
             )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_CANCEL/config",
-            values={
-                "name": _node_name + " Cancel Print",
-                "uniq_id": _node_id + "_CANCEL",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "cancel"),
-                "stat_t": "~" + self._generate_topic("controlTopic", "cancel"),
-                "avty_t": "~" + self._generate_topic("hassTopic", "is_printing"),
-                "pl_avail": "True",
-                "pl_not_avail": "False",
-                "pl_off": "False",
-                "pl_on": "True",
-                "val_tpl": "{{False}}",
-                "device": _config_device,
-                "ic": "mdi:cancel",
-            },
+        _callback = self._trace_control(
+            control, self._filter_control(control, _callback)
         )
-
-        # Pause / resume print
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "pause", full=True),
-                self._on_pause_print,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_PAUSE/config",
-            values={
-                "name": _node_name + " Pause Print",
-                "uniq_id": _node_id + "_PAUSE",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "pause"),
-                "stat_t": "~" + self._generate_topic("hassTopic", "is_paused"),
-                "avty_t": "~" + self._generate_topic("hassTopic", "is_printing"),
-                "pl_avail": "True",
-                "pl_not_avail": "False",
-                "pl_off": "False",
-                "pl_on": "True",
-                "device": _config_device,
-                "ic": "mdi:pause",
-            },
-        )
-
-        # Shutdown OctoPrint
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "shutdown", full=True),
-                self._on_shutdown_system,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_SHUTDOWN/config",
-            values={
-                "name": _node_name + " Shutdown System",
-                "uniq_id": _node_id + "_SHUTDOWN",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "shutdown"),
-                "stat_t": "~" + self._generate_topic("controlTopic", "shutdown"),
-                "pl_off": "False",
-                "pl_on": "True",
-                "val_tpl": "{{False}}",
-                "device": _config_device,
-                "ic": "mdi:power",
-            },
-        )
-
-        # PSUControl
-        if self.psucontrol_enabled:
-            if subscribe:
-                self.mqtt_subscribe(
-                    self._generate_topic("controlTopic", "psu", full=True),
-                    self._on_psu,
-                )
-
-            self._generate_sensor(
-                topic=_discovery_topic + "/switch/" + _node_id + "_PSU/config",
-                values={
-                    "name": _node_name + " PSU",
-                    "uniq_id": _node_id + "_PSU",
-                    "cmd_t": "~" + self._generate_topic("controlTopic", "psu"),
-                    "stat_t": "~" + self._generate_topic("hassTopic", "psu_state"),
-                    "pl_on": "True",
-                    "pl_off": "False",
-                    "device": _config_device,
-                    "ic": "mdi:flash",
-                },
-            )
-
-        # Camera output
-        if self.snapshot_enabled:
-            if subscribe:
-                self.mqtt_subscribe(
-                    self._generate_topic("controlTopic", "camera_snapshot", full=True),
-                    self._on_camera,
+        self._control_subscriptions[control] = (_topic, _callback)
+        self.mqtt_subscribe(_topic, _callback)
+
+    def _unsubscribe_control(self, control):
+        _subscription = self._control_subscriptions.pop(control, None)
+        if _subscription and self.mqtt_unsubscribe:
+            self.mqtt_unsubscribe(_subscription[1], topic=_subscription[0])
+
+    def _filter_control(self, control, callback):
+        def filtered(topic, message, retained=None, qos=None, *args, **kwargs):
+            if not self._inbound_filter.accept(control, message, retained):
+                self._logger.debug("Ignoring replayed or empty message on " + topic)
+                if self._metrics.enabled:
+                    self._metrics.count("handler." + control + ".ignored")
+                return
+            if retained:
+                # Clear it so the broker doesn't replay the command on the next
+                # subscribe, the empty message this produces is ignored
+                self._publish(topic, "", retained=True)
+            return callback(topic, message, retained, qos, *args, **kwargs)
+
+        return filtered
+
+    def _trace_control(self, control, callback):
+        def traced(topic, message, retained=None, qos=None, *args, **kwargs):
+            if self._trace_recorder:
+                self._trace_recorder.record(TRACE_MESSAGE, control, message, retained)
+            return callback(topic, message, retained, qos, *args, **kwargs)
+
+        return traced
+
+    def _subscribe_controls(self, context):
+        for _control in CONTROLS:
+            if available(_control, context):
+                self._subscribe_control(
+                    _control.control,
+                    getattr(self, _control.handler),
+                    policy=_control.policy,
+                    timeout=_control.timeout,
                 )
-
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/switch/"
-                + _node_id
-                + "_CAMERA_SNAPSHOT/config",
-                values={
-                    "name": _node_name + " Camera snapshot",
-                    "uniq_id": _node_id + "_CAMERA_SNAPSHOT",
-                    "cmd_t": "~"
-                    + self._generate_topic("controlTopic", "camera_snapshot"),
-                    "stat_t": "~"
-                    + self._generate_topic("controlTopic", "camera_snapshot"),
-                    "pl_off": "False",
-                    "pl_on": "True",
-                    "val_tpl": "{{False}}",
-                    "device": _config_device,
-                    "ic": "mdi:camera-iris",
-                },
-            )
-
-            self._generate_sensor(
-                topic=_discovery_topic + "/camera/" + _node_id + "_CAMERA/config",
-                values={
-                    "name": _node_name + " Camera",
-                    "uniq_id": _node_id + "_CAMERA",
-                    "device": _config_device,
-                    "topic": self._generate_topic("baseTopic", "camera"),
-                },
-            )
-
-        # Command topics that don't have a suitable sensor configuration. These can be used
-        # through the MQTT.publish service call though.
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "jog", full=True), self._on_jog
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "home", full=True), self._on_home
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "commands", full=True),
-                self._on_command,
-            )
+            else:
+                self._unsubscribe_control(_control.control)
 
     ##~~ EventHandlerPlugin API
 
     def on_event(self, event, payload):
+        if self._trace_recorder:
+            self._trace_recorder.record(TRACE_EVENT, event, payload)
+
         events = dict(
             comm=(
                 Events.CONNECTING,
@@ -932,12 +1346,33 @@ class HomeassistantPlugin(
                 Events.PRINT_RESUMED,
                 Events.Z_CHANGE,
             ),
+            # Published right away instead of being merged with other updates
+            immediate=(
+                Events.ERROR,
+                Events.DISCONNECTED,
+                Events.PRINT_STARTED,
+                Events.PRINT_FAILED,
+                Events.PRINT_DONE,
+                Events.PRINT_CANCELLED,
+                Events.PRINT_PAUSED,
+                Events.PRINT_RESUMED,
+            ),
         )
 
+        # Settings of this plugin or the MQTT plugin may have changed the topics
+        if event == Events.SETTINGS_UPDATED:
+            self._build_topic_table()
+
         # Printer connectivity status events
         if event in events["comm"]:
             self._generate_connection_status()
 
+        # The printer profile was edited, or a different one was selected to connect
+        if event in (Events.PRINTER_PROFILE_MODIFIED, Events.CONNECTED):
+            self._handler_pool.submit(
+                self._update_profile_entities, policy=POLICY_COALESCE
+            )
+
         # Print job status events
         if (
             event in events["comm"]
@@ -945,71 +1380,53 @@ class HomeassistantPlugin(
             or event in events["status"]
         ):
             self._logger.debug("Received event " + event + ", updating status")
-            self._generate_printer_status()
+            self._status_trigger.trigger(immediate=event in events["immediate"])
 
         if event == Events.PRINT_STARTED:
-            if self.update_timer:
-                self.mqtt_publish(
+            if self.mqtt_publish:
+                self._publish(
                     self._generate_topic("hassTopic", "is_printing", full=True),
                     "True",
-                    allow_queueing=True,
                 )
-
-                try:
-                    self.update_timer.start()
-                except RuntimeError:
-                    # May already be running, it's ok
-                    pass
+            # Switch the scheduled jobs to their printing interval
+            self._scheduler.reschedule()
 
         elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
-            if self.update_timer:
-                self.mqtt_publish(
+            if self.mqtt_publish:
+                self._publish(
                     self._generate_topic("hassTopic", "is_printing", full=True),
                     "False",
-                    allow_queueing=True,
                 )
-
-                try:
-                    self.update_timer.cancel()
-                except RuntimeError:
-                    # May already be stopped, it's ok
-                    pass
+            self._scheduler.reschedule()
 
         if event == Events.PRINT_PAUSED:
-            self.mqtt_publish(
+            self._publish(
                 self._generate_topic("hassTopic", "is_paused", full=True),
                 "True",
-                allow_queueing=True,
             )
 
         elif event in (Events.PRINT_RESUMED, Events.PRINT_STARTED):
-            self.mqtt_publish(
+            self._publish(
                 self._generate_topic("hassTopic", "is_paused", full=True),
                 "False",
-                allow_queueing=True,
             )
 
+        # Only registered while PSUControl is installed
         if (
-            event == Events.PLUGIN_PSUCONTROL_PSU_STATE_CHANGED
+            event == getattr(Events, "PLUGIN_PSUCONTROL_PSU_STATE_CHANGED", None)
             and self.psucontrol_enabled
         ):
             self._generate_psu_state(payload["psu_state"])
 
         if event == Events.CAPTURE_DONE:
-            file_handle = open(payload["file"], "rb")
-            file_content = file_handle.read()
-            file_handle.close()
-            self.mqtt_publish(
-                self._generate_topic("baseTopic", "camera", full=True),
-                file_content,
-                allow_queueing=False,
-                raw_data=True,
-            )
+            self._capture_forwarder.submit(payload["file"])
 
     ##~~ ProgressPlugin API
 
     def on_print_progress(self, storage, path, progress):
-        self._generate_printer_status()
+        if self._trace_recorder:
+            self._trace_recorder.record(TRACE_PROGRESS, storage, path, progress)
+        self._status_trigger.trigger()
 
     def on_slicing_progress(
         self,
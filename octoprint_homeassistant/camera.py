@@ -0,0 +1,246 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+except ImportError:
+    import httplib
+    from urlparse import urlsplit
+
+
+class SnapshotTooLarge(Exception):
+    pass
+
+
+class SnapshotService(object):
+    """
+    Fetches webcam snapshots over a persistent HTTP connection. A frame is reused
+    for ttl seconds, frames over max_bytes are refused and frames larger than
+    max_dimension pixels are scaled down and re-encoded as JPEG when Pillow is
+    available.
+    """
+
+    def __init__(
+        self, url, ttl=2, max_bytes=2097152, max_dimension=0, quality=80, timeout=10
+    ):
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._frame = None
+        self._frame_time = 0
+        self._pillow_missing = False
+        self.url = url
+        self.configure(ttl, max_bytes, max_dimension, quality, timeout)
+
+    def configure(
+        self, ttl=2, max_bytes=2097152, max_dimension=0, quality=80, timeout=10
+    ):
+        with self._lock:
+            self.ttl = ttl
+            self.max_bytes = max_bytes
+            self.max_dimension = max_dimension
+            self.quality = quality
+            self.timeout = timeout
+            self._frame = None
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._frame is not None and now - self._frame_time < self.ttl:
+                return self._frame
+
+            frame = self.process(self._fetch())
+            self._frame = frame
+            self._frame_time = now
+            return frame
+
+    def close(self):
+        with self._lock:
+            self._close_connection()
+
+    def process(self, frame):
+        """Scale a JPEG frame down to max_dimension, if configured."""
+        if not self.max_dimension or self._pillow_missing:
+            return frame
+
+        try:
+            from PIL import Image
+        except ImportError:
+            self._logger.warning("Pillow is not installed, snapshots are not resized")
+            self._pillow_missing = True
+            return frame
+
+        try:
+            image = Image.open(io.BytesIO(frame))
+            if max(image.size) <= self.max_dimension:
+                return frame
+            image.thumbnail((self.max_dimension, self.max_dimension))
+            output = io.BytesIO()
+            image.convert("RGB").save(output, "JPEG", quality=self.quality)
+            return output.getvalue()
+        except Exception as e:
+            self._logger.warning("Unable to resize snapshot: " + str(e))
+            return frame
+
+    def _fetch(self):
+        url = urlsplit(self.url)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+
+        # A kept alive connection may have been closed by the webcam server, retry once
+        for attempt in range(2):
+            connection = self._get_connection(url)
+            try:
+                connection.request("GET", path, headers={"Connection": "keep-alive"})
+                response = connection.getresponse()
+                return self._read(response)
+            except SnapshotTooLarge:
+                self._close_connection()
+                raise
+            except (httplib.HTTPException, IOError):
+                self._close_connection()
+                if attempt:
+                    raise
+
+    def _read(self, response):
+        if response.status != 200:
+            response.read()
+            raise IOError("Webcam returned HTTP status " + str(response.status))
+
+        length = response.getheader("Content-Length")
+        if length and int(length) > self.max_bytes:
+            raise SnapshotTooLarge("Snapshot of " + length + " bytes is too large")
+
+        frame = response.read(self.max_bytes + 1)
+        if len(frame) > self.max_bytes:
+            raise SnapshotTooLarge(
+                "Snapshot exceeds " + str(self.max_bytes) + " bytes"
+            )
+        if response.getheader("Connection", "").lower() == "close":
+            self._close_connection()
+        return frame
+
+    def _get_connection(self, url):
+        if self._connection is None:
+            if url.scheme == "https":
+                self._connection = httplib.HTTPSConnection(
+                    url.hostname, url.port, timeout=self.timeout
+                )
+            else:
+                self._connection = httplib.HTTPConnection(
+                    url.hostname, url.port, timeout=self.timeout
+                )
+        return self._connection
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+
+class CameraBudget(object):
+    """Limits the number of camera bytes published in any 60 second window."""
+
+    def __init__(self, bytes_per_minute=0):
+        self._lock = threading.Lock()
+        self._published = deque()
+        self._total = 0
+        self.bytes_per_minute = bytes_per_minute
+
+    def allow(self, size):
+        """Whether size bytes fit in the budget, only charge counts them."""
+        now = time.time()
+        with self._lock:
+            while self._published and now - self._published[0][0] >= 60:
+                self._total -= self._published.popleft()[1]
+            return not (
+                self.bytes_per_minute and self._total + size > self.bytes_per_minute
+            )
+
+    def charge(self, size):
+        """Count size bytes that were published."""
+        with self._lock:
+            self._published.append((time.time(), size))
+            self._total += size
+
+
+class CaptureForwarder(object):
+    """
+    Publishes timelapse frames from a background thread. Only the newest frame
+    waiting to be published is kept, and frames are published at most once every
+    min_interval seconds.
+    """
+
+    def __init__(self, publish, process=None, min_interval=10, max_bytes=2097152):
+        self._logger = logging.getLogger(__name__)
+        self._publish = publish
+        self._condition = threading.Condition()
+        self._pending = None
+        self._published_at = 0
+        self._thread = None
+        self._stopped = False
+        self.process = process
+        self.min_interval = min_interval
+        self.max_bytes = max_bytes
+
+    def submit(self, path):
+        with self._condition:
+            if self._stopped:
+                return
+            if self._pending is not None:
+                self._logger.debug("Dropping timelapse frame " + self._pending)
+            self._pending = path
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="HomeAssistantCapture"
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending = None
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    wait = self._published_at + self.min_interval - time.time()
+                    if self._pending is not None and wait <= 0:
+                        break
+                    self._condition.wait(wait if self._pending is not None else None)
+                if self._stopped:
+                    return
+                path = self._pending
+                self._pending = None
+                self._published_at = time.time()
+
+            try:
+                self._forward(path)
+            except Exception as e:
+                self._logger.error("Unable to publish timelapse frame: " + str(e))
+
+    def _forward(self, path):
+        if os.path.getsize(path) > self.max_bytes:
+            self._logger.warning("Timelapse frame " + path + " is too large")
+            return
+        with open(path, "rb") as f:
+            frame = f.read()
+        if self.process:
+            frame = self.process(frame)
+        self._publish(frame)
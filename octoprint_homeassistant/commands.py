@@ -0,0 +1,173 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from .scheduler import TokenBucket
+
+JOG = "jog"
+HOME = "home"
+COMMANDS = "commands"
+
+
+def parse_commands(message):
+    """
+    G-code lines from a commands message, either a JSON array of commands or one
+    command per line.
+    """
+    if isinstance(message, bytes):
+        message = message.decode("utf-8")
+    if not message:
+        return []
+
+    _message = message.strip()
+    if _message.startswith("["):
+        try:
+            _commands = json.loads(_message)
+        except ValueError:
+            _commands = None
+        if isinstance(_commands, list):
+            return [str(c).strip() for c in _commands if c and str(c).strip()]
+    return [line.strip() for line in _message.splitlines() if line.strip()]
+
+
+class CommandPipeline(object):
+    """
+    Sends jog, home and G-code commands to the printer from a background thread.
+
+    Relative jogs that are still waiting are summed per axis, a jog is held for
+    window seconds so following jogs can be added to it. Consecutive G-code commands
+    are sent as one batch. At most rate commands per second are sent to the printer,
+    0 for no limit.
+    """
+
+    def __init__(self, printer, window=0.25, rate=20):
+        self._logger = logging.getLogger(__name__)
+        self._printer = printer
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._thread = None
+        self._busy = False
+        self._stopped = False
+        self._bucket = TokenBucket(rate)
+        self.window = window
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    @rate.setter
+    def rate(self, rate):
+        self._bucket.rate = rate
+
+    def jog(self, axes, speed=None):
+        with self._condition:
+            _last = self._pending[-1] if self._pending else None
+            if _last is not None and _last[0] == JOG and _last[2] == speed:
+                for axis, distance in axes.items():
+                    _last[1][axis] = _last[1].get(axis, 0) + distance
+                return
+            self._submit([JOG, dict(axes), speed, time.time()])
+
+    def home(self, axes):
+        with self._condition:
+            self._submit([HOME, list(axes), None, time.time()])
+
+    def commands(self, commands):
+        if not commands:
+            return
+        with self._condition:
+            _last = self._pending[-1] if self._pending else None
+            if _last is not None and _last[0] == COMMANDS:
+                _last[1].extend(commands)
+                return
+            self._submit([COMMANDS, list(commands), None, time.time()])
+
+    def _submit(self, operation):
+        if self._stopped:
+            return
+        self._pending.append(operation)
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="HomeAssistantCommands"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until all pending commands were sent, returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while (self._pending or self._busy) and not self._stopped:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._pending:
+                        _next = self._pending[0]
+                        # A jog that is last in line may still be added to
+                        wait = _next[3] + self.window - time.time()
+                        if _next[0] != JOG or len(self._pending) > 1 or wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                if self._stopped:
+                    return
+                operation = self._pending.popleft()
+                self._busy = True
+
+            try:
+                self._dispatch(operation)
+            except Exception as e:
+                self._logger.error(
+                    "Unable to run " + operation[0] + " command: " + str(e)
+                )
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _dispatch(self, operation):
+        kind, payload, speed, _ = operation
+        if kind == COMMANDS:
+            while payload:
+                _count = self._acquire(len(payload))
+                if not _count:
+                    return
+                self._printer.commands(payload[:_count])
+                payload = payload[_count:]
+        elif self._acquire(1):
+            if kind == JOG:
+                self._printer.jog(payload, speed=speed)
+            elif kind == HOME:
+                self._printer.home(payload)
+
+    def _acquire(self, count):
+        # Returns how many of count may be sent now, waits for at least one. 0 once
+        # stopped.
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return 0
+                _count = self._bucket.take(count)
+                if _count:
+                    return _count
+                self._condition.wait(self._bucket.delay())
@@ -0,0 +1,492 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re
+from collections import namedtuple
+
+from .workers import POLICY_COALESCE, POLICY_DROP, POLICY_QUEUE
+
+# Features an entity may require, see compile_entities
+FEATURE_HEATED_CHAMBER = "heated_chamber"
+FEATURE_PSUCONTROL = "psucontrol"
+FEATURE_SNAPSHOT = "snapshot"
+FEATURE_METRICS = "metrics"
+
+# Paths into the payload referenced by a template
+_VALUE_PATH = re.compile(r"value_json((?:\.\w+)*)")
+
+# Entities repeated for every extruder of the printer profile replace this in their
+# suffix, name and topics with the tool number
+TOOL = "{tool}"
+
+
+class Topic(namedtuple("Topic", "topic_type topic full")):
+    """A topic of the MQTT plugin, relative to the base topic ("~") unless full."""
+
+    def __new__(cls, topic_type, topic, full=False):
+        return super(Topic, cls).__new__(cls, topic_type, topic, full)
+
+
+class StatusTopic(namedtuple("StatusTopic", "field")):
+    """The topic a field of the printer status is published on."""
+
+
+class StatusTemplate(namedtuple("StatusTemplate", "field template")):
+    """A template reading a field of the printer status, %s is the field's path."""
+
+
+Entity = namedtuple("Entity", "component suffix name values requires repeat_tools")
+
+
+def entity(component, suffix, name, values, requires=(), repeat_tools=False):
+    return Entity(component, suffix, name, values, requires, repeat_tools)
+
+
+Control = namedtuple("Control", "control handler policy timeout requires")
+
+
+def control(control, handler, policy=POLICY_QUEUE, timeout=30, requires=()):
+    return Control(control, handler, policy, timeout, requires)
+
+
+_SWITCH = {"pl_off": "False", "pl_on": "True"}
+_AVAILABLE_WHILE_PRINTING = {
+    "avty_t": Topic("hassTopic", "is_printing"),
+    "pl_avail": "True",
+    "pl_not_avail": "False",
+}
+
+
+def _values(*parts, **values):
+    result = {}
+    for part in parts:
+        result.update(part)
+    result.update(values)
+    return result
+
+
+def _temperature(topic, value, icon):
+    return {
+        "stat_t": Topic("temperatureTopic", topic),
+        "unit_of_meas": "°C",
+        "val_tpl": "{{value_json." + value + "|float}}",
+        "dev_cla": "temperature",
+        "ic": icon,
+    }
+
+
+ENTITIES = (
+    entity(
+        "binary_sensor",
+        "CONNECTED",
+        "Connected",
+        {
+            "stat_t": Topic("hassTopic", "Connected"),
+            "pl_on": "Connected",
+            "pl_off": "Disconnected",
+            "dev_cla": "connectivity",
+        },
+    ),
+    entity(
+        "binary_sensor",
+        "PRINTING",
+        "Printing",
+        {
+            "stat_t": StatusTopic("state"),
+            "pl_on": "True",
+            "pl_off": "False",
+            "val_tpl": StatusTemplate("state", "{{%s.flags.printing}}"),
+        },
+    ),
+    entity(
+        "sensor",
+        "EVENT",
+        "Last Event",
+        {
+            "stat_t": Topic("eventTopic", "+"),
+            "val_tpl": "{{value_json._event}}",
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_S",
+        "Print Status",
+        {
+            "stat_t": StatusTopic("state"),
+            "json_attr_t": StatusTopic("state"),
+            "json_attr_tpl": StatusTemplate("state", "{{%s|tojson}}"),
+            "val_tpl": StatusTemplate("state", "{{%s.text}}"),
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_P",
+        "Print Progress",
+        {
+            "json_attr_t": StatusTopic("progress"),
+            "json_attr_tpl": StatusTemplate("progress", "{{%s|tojson}}"),
+            "stat_t": Topic("progressTopic", "printing"),
+            "unit_of_meas": "%",
+            "val_tpl": "{{value_json.progress|float|default(0,true)}}",
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_F",
+        "Print File",
+        {
+            "stat_t": Topic("progressTopic", "printing"),
+            "val_tpl": "{{value_json.path}}",
+            "ic": "mdi:file",
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_T",
+        "Print Time",
+        {
+            "stat_t": StatusTopic("progress"),
+            "val_tpl": StatusTemplate("progress", "{{%s.printTimeFormatted}}"),
+            "ic": "mdi:clock-start",
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_E",
+        "Print Time Left",
+        {
+            "stat_t": StatusTopic("progress"),
+            "val_tpl": StatusTemplate("progress", "{{%s.printTimeLeftFormatted}}"),
+            "ic": "mdi:clock-end",
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_ETA",
+        "Print Estimated Time",
+        {
+            "stat_t": StatusTopic("job"),
+            "json_attr_t": StatusTopic("job"),
+            "json_attr_tpl": StatusTemplate("job", "{{%s|tojson}}"),
+            "val_tpl": StatusTemplate("job", "{{%s.estimatedPrintTimeFormatted}}"),
+        },
+    ),
+    entity(
+        "sensor",
+        "PRINTING_Z",
+        "Current Z",
+        {
+            "stat_t": StatusTopic("currentZ"),
+            "unit_of_meas": "mm",
+            "val_tpl": StatusTemplate("currentZ", "{{%s|float}}"),
+            "ic": "mdi:axis-z-arrow",
+        },
+    ),
+    entity(
+        "sensor",
+        "SLICING_P",
+        "Slicing Progress",
+        {
+            "stat_t": Topic("progressTopic", "slicing"),
+            "unit_of_meas": "%",
+            "val_tpl": "{{value_json.progress|float|default(0,true)}}",
+        },
+    ),
+    entity(
+        "sensor",
+        "SLICING_F",
+        "Slicing File",
+        {
+            "stat_t": Topic("progressTopic", "slicing"),
+            "val_tpl": "{{value_json.source_path}}",
+            "ic": "mdi:file",
+        },
+    ),
+    entity(
+        "sensor",
+        "TOOL" + TOOL,
+        "Tool " + TOOL + " Temperature",
+        _temperature("tool" + TOOL, "actual", "mdi:printer-3d-nozzle"),
+        repeat_tools=True,
+    ),
+    entity(
+        "sensor",
+        "TOOL" + TOOL + "_TARGET",
+        "Tool " + TOOL + " Target",
+        _temperature("tool" + TOOL, "target", "mdi:printer-3d-nozzle"),
+        repeat_tools=True,
+    ),
+    entity(
+        "sensor",
+        "BED",
+        "Bed Temperature",
+        _temperature("bed", "actual", "mdi:radiator"),
+    ),
+    entity(
+        "sensor",
+        "BED_TARGET",
+        "Bed Target",
+        _temperature("bed", "target", "mdi:radiator"),
+    ),
+    entity(
+        "sensor",
+        "CHAMBER",
+        "Chamber Temperature",
+        _temperature("chamber", "actual", "mdi:radiator"),
+        requires=(FEATURE_HEATED_CHAMBER,),
+    ),
+    entity(
+        "sensor",
+        "CHAMBER_TARGET",
+        "Chamber Target",
+        _temperature("chamber", "target", "mdi:radiator"),
+        requires=(FEATURE_HEATED_CHAMBER,),
+    ),
+    entity(
+        "sensor",
+        "DIAGNOSTICS",
+        "MQTT Messages",
+        {
+            "stat_t": Topic("hassTopic", "diagnostics"),
+            "json_attr_t": Topic("hassTopic", "diagnostics"),
+            "val_tpl": "{{value_json.messages}}",
+            "ent_cat": "diagnostic",
+            "stat_cla": "total_increasing",
+            "ic": "mdi:chart-line",
+        },
+        requires=(FEATURE_METRICS,),
+    ),
+    entity(
+        "sensor",
+        "SOC",
+        "SoC Temperature",
+        _values(
+            _temperature("soc", "temperature", "mdi:radiator"),
+            val_tpl="{{value_json.temperature|float|round(1)}}",
+        ),
+    ),
+    entity(
+        "switch",
+        "STOP",
+        "Emergency Stop",
+        _values(
+            _SWITCH,
+            cmd_t=Topic("controlTopic", "stop"),
+            stat_t=Topic("controlTopic", "stop"),
+            val_tpl="{{False}}",
+            ic="mdi:alert-octagon",
+        ),
+    ),
+    entity(
+        "switch",
+        "CANCEL",
+        "Cancel Print",
+        _values(
+            _SWITCH,
+            _AVAILABLE_WHILE_PRINTING,
+            cmd_t=Topic("controlTopic", "cancel"),
+            stat_t=Topic("controlTopic", "cancel"),
+            val_tpl="{{False}}",
+            ic="mdi:cancel",
+        ),
+    ),
+    entity(
+        "switch",
+        "PAUSE",
+        "Pause Print",
+        _values(
+            _SWITCH,
+            _AVAILABLE_WHILE_PRINTING,
+            cmd_t=Topic("controlTopic", "pause"),
+            stat_t=Topic("hassTopic", "is_paused"),
+            ic="mdi:pause",
+        ),
+    ),
+    entity(
+        "switch",
+        "SHUTDOWN",
+        "Shutdown System",
+        _values(
+            _SWITCH,
+            cmd_t=Topic("controlTopic", "shutdown"),
+            stat_t=Topic("controlTopic", "shutdown"),
+            val_tpl="{{False}}",
+            ic="mdi:power",
+        ),
+    ),
+    entity(
+        "switch",
+        "PSU",
+        "PSU",
+        _values(
+            _SWITCH,
+            cmd_t=Topic("controlTopic", "psu"),
+            stat_t=Topic("hassTopic", "psu_state"),
+            ic="mdi:flash",
+        ),
+        requires=(FEATURE_PSUCONTROL,),
+    ),
+    entity(
+        "switch",
+        "CAMERA_SNAPSHOT",
+        "Camera snapshot",
+        _values(
+            _SWITCH,
+            cmd_t=Topic("controlTopic", "camera_snapshot"),
+            stat_t=Topic("controlTopic", "camera_snapshot"),
+            val_tpl="{{False}}",
+            ic="mdi:camera-iris",
+        ),
+        requires=(FEATURE_SNAPSHOT,),
+    ),
+    entity(
+        "camera",
+        "CAMERA",
+        "Camera",
+        {"topic": Topic("baseTopic", "camera", full=True)},
+        requires=(FEATURE_SNAPSHOT,),
+    ),
+)
+
+# Control topics the plugin subscribes to, handler is the name of the plugin's method.
+# Without a policy the handler runs on the MQTT thread, the emergency stop should
+# never wait behind other handlers.
+CONTROLS = (
+    control("stop", "_on_emergency_stop", policy=None),
+    control("cancel", "_on_cancel_print", policy=POLICY_DROP),
+    control("pause", "_on_pause_print", policy=POLICY_COALESCE),
+    control("shutdown", "_on_shutdown_system", policy=POLICY_DROP),
+    control(
+        "psu", "_on_psu", policy=POLICY_COALESCE, requires=(FEATURE_PSUCONTROL,)
+    ),
+    control(
+        "camera_snapshot",
+        "_on_camera",
+        policy=POLICY_DROP,
+        timeout=15,
+        requires=(FEATURE_SNAPSHOT,),
+    ),
+    # Command topics that don't have a suitable entity, these can be used through
+    # the mqtt.publish service in Home Assistant
+    control("jog", "_on_jog"),
+    control("home", "_on_home"),
+    control("commands", "_on_command"),
+)
+
+
+class EntityContext(
+    namedtuple(
+        "EntityContext",
+        "discovery_topic node_id node_name device topics status_field_topics "
+        "tools features disabled",
+    )
+):
+    """
+    Everything compiling the entities depends on. topics is the topic table
+    relative to the base topic, features the set of available features and
+    disabled the suffixes of the entities the user switched off.
+    """
+
+    def resolve(self, value, tool=None):
+        if isinstance(value, Topic):
+            topic = value.topic if tool is None else value.topic.replace(TOOL, tool)
+            if value.full:
+                return self.topics["baseTopic"] + topic
+            return "~" + self.topics[value.topic_type] + topic
+        if isinstance(value, StatusTopic):
+            if self.status_field_topics:
+                return "~" + self.topics["hassTopic"] + "printing/" + value.field
+            return "~" + self.topics["hassTopic"] + "printing"
+        if isinstance(value, StatusTemplate):
+            if self.status_field_topics:
+                return value.template % "value_json"
+            return value.template % ("value_json." + value.field)
+        return value
+
+
+def available(item, context):
+    return all(feature in context.features for feature in item.requires)
+
+
+def _suffixes(item, tools):
+    # Pairs of suffix and tool for the entity, tool is None unless it is repeated
+    if not item.repeat_tools:
+        return [(item.suffix, None)]
+    return [(item.suffix.replace(TOOL, str(x)), str(x)) for x in range(tools)]
+
+
+def compile_entities(context, entities=ENTITIES):
+    """
+    Build the discovery configs of the entities for context, returns a list of
+    (suffix, topic, values) tuples.
+    """
+    compiled = []
+    for item in entities:
+        if not available(item, context):
+            continue
+
+        for suffix, tool in _suffixes(item, context.tools):
+            if suffix in context.disabled:
+                continue
+            name = item.name if tool is None else item.name.replace(TOOL, tool)
+
+            values = {
+                "name": context.node_name + " " + name,
+                "uniq_id": context.node_id + "_" + suffix,
+            }
+            for key, value in item.values.items():
+                values[key] = context.resolve(value, tool)
+            values["device"] = context.device
+
+            topic = (
+                context.discovery_topic
+                + "/"
+                + item.component
+                + "/"
+                + context.node_id
+                + "_"
+                + suffix
+                + "/config"
+            )
+            compiled.append((suffix, topic, values))
+    return compiled
+
+
+def entity_names(tools, entities=ENTITIES):
+    """
+    Suffix and name of every entity for a printer with this many tools, regardless
+    of the features it requires.
+    """
+    names = []
+    for item in entities:
+        for suffix, tool in _suffixes(item, tools):
+            names.append(
+                (suffix, item.name if tool is None else item.name.replace(TOOL, tool))
+            )
+    return names
+
+
+def status_paths(context, entities=ENTITIES):
+    """
+    The paths into the printer status that the templates of the enabled entities in
+    context read, a field without a template is read whole.
+    """
+    paths = set()
+    for item in entities:
+        if not available(item, context):
+            continue
+        suffixes = _suffixes(item, context.tools)
+        if all(suffix in context.disabled for suffix, _ in suffixes):
+            continue
+
+        templated = set()
+        for value in item.values.values():
+            if isinstance(value, StatusTemplate):
+                templated.add(value.field)
+                template = value.template % ("value_json." + value.field)
+                for match in _VALUE_PATH.finditer(template):
+                    paths.add(tuple(match.group(1).split(".")[1:]))
+        for value in item.values.values():
+            if isinstance(value, StatusTopic) and value.field not in templated:
+                paths.add((value.field,))
+    return paths
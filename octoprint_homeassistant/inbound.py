@@ -0,0 +1,54 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+
+
+def message_timestamp(message):
+    """The _timestamp of a JSON message, None if it has none."""
+    if isinstance(message, bytes):
+        try:
+            message = message.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    if not isinstance(message, str) or not message.lstrip().startswith("{"):
+        return None
+    try:
+        _timestamp = json.loads(message).get("_timestamp")
+    except (ValueError, AttributeError):
+        return None
+    if isinstance(_timestamp, (int, float)) and not isinstance(_timestamp, bool):
+        return _timestamp
+    return None
+
+
+class InboundFilter(object):
+    """
+    Decides whether a control message should be acted on. The broker replays
+    retained messages on every subscribe, those are only accepted when they carry a
+    _timestamp newer than the last message applied on the same control, or newer
+    than the start of the plugin. Empty messages, which is what clearing a retained
+    message produces, are never accepted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._applied = {}
+
+    def accept(self, control, message, retained=False):
+        if not message:
+            return False
+
+        _timestamp = message_timestamp(message)
+        with self._lock:
+            if retained:
+                _last = self._applied.get(control, self._started)
+                if _timestamp is None or _timestamp <= _last:
+                    return False
+            self._applied[control] = (
+                time.time() if _timestamp is None else _timestamp
+            )
+            return True
@@ -0,0 +1,135 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from octoprint.util import atomic_write
+
+
+class DiscoveryLedger(object):
+    """
+    Remembers a hash of every discovery config that was published, keyed by topic,
+    so a re-registration only has to publish the configs that actually changed and
+    can clear the ones that are no longer generated.
+    """
+
+    def __init__(self, path):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self._lock = threading.RLock()
+        self._hashes = {}
+        # Hashes handed out by update that weren't committed or released yet
+        self._pending = {}
+        self._seen = None
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def payload_hash(payload):
+        _canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(_canonical.encode("utf-8")).hexdigest()
+
+    def published(self, topic):
+        """Whether a config is published on topic."""
+        with self._lock:
+            return topic in self._hashes
+
+    def begin(self):
+        with self._lock:
+            self._seen = set()
+
+    def update(self, topic, payload, force=False):
+        """
+        Note that topic was generated, returns the hash of the payload if it needs
+        to be published and None if it was published before, or is being published.
+        With force it always needs to be. The hash is only recorded by commit once
+        it was published, or forgotten by release if that failed.
+        """
+        _hash = self.payload_hash(payload)
+        with self._lock:
+            if self._seen is not None:
+                self._seen.add(topic)
+            if not force and _hash in (
+                self._hashes.get(topic),
+                self._pending.get(topic),
+            ):
+                return None
+            self._pending[topic] = _hash
+            return _hash
+
+    def release(self, topic, payload_hash):
+        """The payload with payload_hash couldn't be published on topic."""
+        with self._lock:
+            if self._pending.get(topic) == payload_hash:
+                del self._pending[topic]
+
+    def commit(self, topic, payload_hash):
+        """
+        Record that the payload with payload_hash was published on topic, it's
+        written by the next save.
+        """
+        with self._lock:
+            self.release(topic, payload_hash)
+            if self._hashes.get(topic) == payload_hash:
+                return
+            self._hashes[topic] = payload_hash
+            self._dirty = True
+
+    def finish(self):
+        """Close a registration pass, returns the topics that were not generated."""
+        with self._lock:
+            _stale = []
+            if self._seen is not None:
+                _stale = [t for t in self._hashes if t not in self._seen]
+                for _topic in _stale:
+                    del self._hashes[_topic]
+                    # Its config is replaced by the empty message, if still waiting
+                    self._pending.pop(_topic, None)
+                    self._dirty = True
+                self._seen = None
+            self._save()
+            return _stale
+
+    def remove(self, topic):
+        """Forget topic, its config was cleared. It's written by the next save."""
+        with self._lock:
+            self._pending.pop(topic, None)
+            if self._hashes.pop(topic, None) is not None:
+                self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._hashes = {}
+            self._pending = {}
+            self._dirty = True
+            self._save()
+
+    def save(self):
+        """Write what was committed since the last save."""
+        with self._lock:
+            self._save()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                _hashes = json.load(f)
+            if isinstance(_hashes, dict):
+                self._hashes = _hashes
+        except Exception as e:
+            self._logger.warning("Unable to read discovery ledger: " + str(e))
+
+    def _save(self):
+        if not self._dirty:
+            return
+        try:
+            with atomic_write(self._path, mode="wt") as f:
+                json.dump(self._hashes, f, sort_keys=True)
+            self._dirty = False
+        except Exception as e:
+            self._logger.warning("Unable to write discovery ledger: " + str(e))
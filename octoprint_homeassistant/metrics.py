@@ -0,0 +1,146 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import functools
+import json
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(
+                zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)
+            ),
+        }
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of what the plugin publishes and handles. The
+    wrappers only check the enabled flag when metrics are disabled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._since = time.time()
+            self._counters = {}
+            self._histograms = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def wrap_publish(self, publish, classify):
+        """Wrap an MQTT publish helper, classify maps a topic to its topic class."""
+
+        @functools.wraps(publish)
+        def wrapper(topic, payload, *args, **kwargs):
+            if not self.enabled:
+                return publish(topic, payload, *args, **kwargs)
+
+            start = time.time()
+            result = publish(topic, payload, *args, **kwargs)
+            elapsed = time.time() - start
+
+            if isinstance(payload, bytes):
+                size = len(payload)
+            elif isinstance(payload, str):
+                size = len(payload.encode("utf-8"))
+            else:
+                size = len(json.dumps(payload))
+            topic_class = classify(topic)
+            self.count("publish." + topic_class + ".messages")
+            self.count("publish." + topic_class + ".bytes", size)
+            self.observe("publish." + topic_class, elapsed)
+            return result
+
+        return wrapper
+
+    def wrap(self, name, func):
+        """Wrap a callback to count its calls and record their duration under name."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.time() - start)
+
+        return wrapper
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "since": self._since,
+                "counters": dict(self._counters),
+                "histograms": dict(
+                    (name, histogram.to_dict())
+                    for (name, histogram) in self._histograms.items()
+                ),
+            }
+
+    def summary(self):
+        """A compact version of the snapshot, for the diagnostics sensor."""
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        summary = {
+            "messages": 0,
+            "bytes": 0,
+            "uptime": int(time.time() - snapshot["since"]),
+        }
+        for name, histogram in snapshot["histograms"].items():
+            summary[name] = {
+                "count": histogram["count"],
+                "mean_ms": round(histogram["mean"] * 1000, 3),
+                "max_ms": round(histogram["max"] * 1000, 3),
+            }
+            if name.startswith("publish."):
+                summary[name]["bytes"] = counters.get(name + ".bytes", 0)
+                summary["messages"] += counters.get(name + ".messages", 0)
+                summary["bytes"] += counters.get(name + ".bytes", 0)
+        return summary
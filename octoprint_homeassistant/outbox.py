@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from octoprint.util import atomic_write
+
+
+class Outbox(object):
+    """
+    Holds the messages that couldn't be published while the broker was unreachable.
+    Only the latest payload per topic is kept, a newer state makes the older one
+    worthless, and the oldest topics are dropped once max_bytes is exceeded. With a
+    path the pending messages are written there on close and loaded again on start,
+    the file is removed once they were all published.
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 1024):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._messages = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._messages)
+
+    @staticmethod
+    def _payload_size(payload):
+        if isinstance(payload, bytes):
+            return len(payload)
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        return len(payload.encode("utf-8"))
+
+    def put(self, topic, payload, retained=False):
+        _size = self._payload_size(payload) + len(topic)
+        with self._lock:
+            self._remove(topic)
+            self._messages[topic] = (payload, retained, _size)
+            self._size += _size
+
+            while self._size > self.max_bytes and len(self._messages) > 1:
+                _topic = next(iter(self._messages))
+                self._logger.debug("Outbox full, dropping " + _topic)
+                self._remove(_topic)
+
+    def discard(self, topic):
+        """Forget the pending message for topic, a newer one was published."""
+        if topic not in self._messages:
+            return
+        with self._lock:
+            self._remove(topic)
+
+    def _remove(self, topic):
+        _message = self._messages.pop(topic, None)
+        if _message is not None:
+            self._size -= _message[2]
+
+    def flush(self, publish):
+        """
+        Publish the pending messages oldest first, stops at the first message
+        publish refuses and keeps it with the rest. Returns the number published.
+        """
+        _published = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._messages:
+                        break
+                    _topic, (_payload, _retained, _) = next(
+                        iter(self._messages.items())
+                    )
+
+                if publish(_topic, _payload, retained=_retained) is False:
+                    break
+
+                with self._lock:
+                    # Unless it was replaced while publishing
+                    _message = self._messages.get(_topic)
+                    if _message is not None and _message[0] is _payload:
+                        self._remove(_topic)
+                _published += 1
+
+            with self._lock:
+                if not self._messages:
+                    self._remove_file()
+        return _published
+
+    def close(self):
+        self._save()
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                _messages = json.load(f)
+            for _topic, _payload, _retained in _messages:
+                self.put(_topic, _payload, _retained)
+        except Exception as e:
+            self._logger.warning("Unable to read outbox: " + str(e))
+
+    def _remove_file(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            os.remove(self._path)
+        except OSError as e:
+            self._logger.warning("Unable to remove outbox: " + str(e))
+
+    def _save(self):
+        if not self._path:
+            return
+        with self._lock:
+            # Raw data such as camera frames is not worth keeping across a restart
+            _messages = [
+                (_topic, _payload, _retained)
+                for (_topic, (_payload, _retained, _)) in self._messages.items()
+                if not isinstance(_payload, bytes)
+            ]
+        if not _messages:
+            self._remove_file()
+            return
+        try:
+            with atomic_write(self._path, mode="wt") as f:
+                json.dump(_messages, f)
+        except Exception as e:
+            self._logger.warning("Unable to write outbox: " + str(e))
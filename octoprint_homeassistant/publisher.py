@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+from collections import OrderedDict, deque
+
+
+class Publisher(object):
+    """
+    Runs all publishing from a single thread. Every operation is submitted with a
+    key, usually its topic. Operations waiting with the same key are collapsed to
+    the latest one, which is run in the position it was submitted in.
+
+    Submitting only appends to a deque, so callers never wait on a lock or on the
+    broker.
+    """
+
+    def __init__(self, name="HomeAssistantPublisher"):
+        self._logger = logging.getLogger(__name__)
+        self._name = name
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stopped = False
+
+    def submit(self, key, operation):
+        if self._stopped:
+            return False
+        self._queue.append((key, operation))
+        if self._thread is None:
+            self._start()
+        self._wakeup.set()
+        return True
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait until everything submitted before has been run."""
+        _done = threading.Event()
+        if not self.submit(object(), _done.set):
+            return False
+        return _done.wait(timeout)
+
+    def stop(self, timeout=2):
+        """Run what is waiting and stop."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _drain(self):
+        _operations = OrderedDict()
+        while True:
+            try:
+                key, operation = self._queue.popleft()
+            except IndexError:
+                return _operations
+            _operations.pop(key, None)
+            _operations[key] = operation
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            for operation in self._drain().values():
+                try:
+                    operation()
+                except Exception as e:
+                    self._logger.error("Unable to publish: " + str(e))
+
+            if self._stopped and not self._queue:
+                return
@@ -0,0 +1,151 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class _Job(object):
+    def __init__(self, name, callback, interval):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.last_run = 0
+        self.generation = 0
+
+
+class Scheduler(object):
+    """
+    Runs periodic jobs from a single thread. The interval of a job is a callable
+    that is asked again after every run and on reschedule, so a job can change its
+    cadence with the printer state or pause by returning None or 0.
+    """
+
+    def __init__(self, name="HomeAssistantScheduler"):
+        self._logger = logging.getLogger(__name__)
+        self._name = name
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, name, callback, interval):
+        with self._condition:
+            self._jobs[name] = _Job(name, callback, interval)
+            self._schedule(self._jobs[name], time.time())
+            self._condition.notify()
+
+    def reschedule(self, name=None):
+        """Ask the jobs for their interval again, without waiting for their next run."""
+        now = time.time()
+        with self._condition:
+            for job in self._jobs.values():
+                if name is None or job.name == name:
+                    self._schedule(job, now)
+            self._condition.notify()
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=self._name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._thread = None
+            self._condition.notify()
+
+    def _schedule(self, job, now):
+        job.generation += 1
+        try:
+            interval = job.interval()
+        except Exception:
+            self._logger.exception("Unable to determine interval of " + job.name)
+            interval = None
+        if not interval:
+            return
+        due = max(now, job.last_run + interval)
+        heapq.heappush(self._queue, (due, next(self._sequence), job, job.generation))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = None
+                while not self._stopped:
+                    if self._queue:
+                        due, _, job, generation = self._queue[0]
+                        if generation != job.generation:
+                            # Superseded by a reschedule
+                            heapq.heappop(self._queue)
+                            job = None
+                            continue
+                        wait = due - time.time()
+                        if wait <= 0:
+                            heapq.heappop(self._queue)
+                            break
+                        job = None
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                if self._stopped:
+                    return
+                job.last_run = time.time()
+
+            try:
+                job.callback()
+            except Exception:
+                self._logger.exception("Error running scheduled job " + job.name)
+
+            with self._condition:
+                if job.name in self._jobs and self._jobs[job.name] is job:
+                    self._schedule(job, time.time())
+
+
+class TokenBucket(object):
+    """
+    Allows rate operations per second on average, in bursts of up to a second worth
+    of them. A rate of 0 or None allows everything.
+    """
+
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._refilled_at = None
+        self.rate = rate
+
+    def take(self, count=1):
+        """Take up to count tokens, returns how many were taken."""
+        if not self.rate:
+            return count
+        with self._lock:
+            now = time.time()
+            if self._refilled_at is None:
+                self._tokens = self.rate
+            else:
+                self._tokens = min(
+                    self.rate, self._tokens + (now - self._refilled_at) * self.rate
+                )
+            self._refilled_at = now
+            if self._tokens < 1:
+                return 0
+            _count = min(count, int(self._tokens))
+            self._tokens -= _count
+            return _count
+
+    def delay(self):
+        """Seconds until the next token is available."""
+        if not self.rate:
+            return 0
+        with self._lock:
+            if self._tokens is None or self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self.rate
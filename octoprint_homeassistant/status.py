@@ -0,0 +1,163 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+
+# Fields of the printer data that the discovery templates use
+STATUS_FIELDS = ("state", "job", "progress", "currentZ")
+
+# Encoders are built once, json.dumps builds a new one for every call with options
+_ENCODER = json.JSONEncoder(separators=(",", ":"), default=str)
+_SIGNATURE_ENCODER = json.JSONEncoder(
+    sort_keys=True, separators=(",", ":"), default=str
+)
+
+# Fields that change every second while printing, these alone only trigger a publish
+# once the time resolution has passed
+STATUS_TIME_FIELDS = (
+    "printTime",
+    "printTimeLeft",
+    "printTimeFormatted",
+    "printTimeLeftFormatted",
+)
+
+
+class StatusProjection(object):
+    """
+    Copies the paths of the printer status that the discovery templates read into a
+    slim payload. A path is a tuple of keys, the value at its end is copied whole.
+    """
+
+    def __init__(self, paths):
+        self._tree = {}
+        # Shorter paths first, a value that is copied whole needs no deeper paths
+        for path in sorted(paths, key=len):
+            node = self._tree
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+                if node is None:
+                    break
+            else:
+                node[path[-1]] = None
+        self.fields = tuple(field for field in STATUS_FIELDS if field in self._tree)
+
+    def _project(self, tree, value):
+        result = {}
+        for key, subtree in tree.items():
+            if key not in value:
+                continue
+            _value = value[key]
+            if subtree is not None and isinstance(_value, dict):
+                _value = self._project(subtree, _value)
+            result[key] = _value
+        return result
+
+    def project(self, data):
+        return self._project(self._tree, data)
+
+    @staticmethod
+    def encode(value):
+        return _ENCODER.encode(value)
+
+
+class StatusTracker(object):
+    """
+    Keeps the signature of the last published printer status per field, to skip
+    publishing snapshots where nothing relevant changed.
+    """
+
+    def __init__(self, fields=STATUS_FIELDS, time_fields=STATUS_TIME_FIELDS):
+        self._fields = fields
+        self._time_fields = time_fields
+        self._lock = threading.Lock()
+        self._signatures = {}
+
+    @staticmethod
+    def _signature(value):
+        return _SIGNATURE_ENCODER.encode(value)
+
+    def _without_time(self, value):
+        if isinstance(value, dict):
+            return dict(
+                (k, v) for (k, v) in value.items() if k not in self._time_fields
+            )
+        return value
+
+    def reset(self):
+        with self._lock:
+            self._signatures = {}
+
+    def update(self, data, time_resolution=60, per_field=False, fields=None):
+        """
+        Compare data with the last published status and remember it, returns the
+        fields that changed. Unless per_field is set, all fields are returned as
+        soon as one of them changed since they are published together. fields
+        limits the comparison to a subset of the tracked fields.
+        """
+        now = time.time()
+        _fields = self._fields if fields is None else fields
+        with self._lock:
+            _signatures = {}
+            _changed = []
+            for field in _fields:
+                _value = data.get(field)
+                _signature = self._signature(self._without_time(_value))
+                _time_signature = self._signature(_value)
+                _signatures[field] = (_signature, _time_signature, now)
+
+                _last = self._signatures.get(field)
+                if (
+                    _last is None
+                    or _last[0] != _signature
+                    or (
+                        _last[1] != _time_signature
+                        and now - _last[2] >= time_resolution
+                    )
+                ):
+                    _changed.append(field)
+
+            if _changed and not per_field:
+                _changed = list(_fields)
+            for field in _changed:
+                self._signatures[field] = _signatures[field]
+            return _changed
+
+
+class CoalescingTrigger(object):
+    """
+    Merges bursts of triggers into a single call of callback at the end of a window,
+    an immediate trigger runs the callback right away and drops the pending one.
+    """
+
+    def __init__(self, callback, window=1.0):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._timer = None
+        self.window = window
+
+    def trigger(self, immediate=False):
+        with self._lock:
+            if not immediate and self.window > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._cancel_timer()
+        self._callback()
+
+    def cancel(self):
+        with self._lock:
+            self._cancel_timer()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self._callback()
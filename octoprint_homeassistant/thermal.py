@@ -0,0 +1,105 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import glob
+import logging
+import os
+import re
+
+# Sensor names as reported by psutil.sensors_temperatures, in order of preference
+SOC_SENSOR_NAMES = ("coretemp", "cpu-thermal", "cpu_thermal")
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _natural_key(path):
+    return [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", path)]
+
+
+def find_soc_sensor(root="/sys"):
+    """
+    Find the sysfs file with the temperature of the SoC, using the same sensor names
+    psutil.sensors_temperatures reports. Returns None if there is no such sensor.
+    """
+    candidates = {}
+
+    for hwmon in sorted(
+        glob.glob(os.path.join(root, "class", "hwmon", "hwmon*")), key=_natural_key
+    ):
+        name = _read_text(os.path.join(hwmon, "name"))
+        if name not in SOC_SENSOR_NAMES or name in candidates:
+            continue
+        inputs = glob.glob(os.path.join(hwmon, "temp*_input")) or glob.glob(
+            os.path.join(hwmon, "device", "temp*_input")
+        )
+        if inputs:
+            candidates[name] = sorted(inputs, key=_natural_key)[0]
+
+    for zone in sorted(
+        glob.glob(os.path.join(root, "class", "thermal", "thermal_zone*")),
+        key=_natural_key,
+    ):
+        name = _read_text(os.path.join(zone, "type"))
+        if name not in SOC_SENSOR_NAMES or name in candidates:
+            continue
+        if os.path.exists(os.path.join(zone, "temp")):
+            candidates[name] = os.path.join(zone, "temp")
+
+    for name in SOC_SENSOR_NAMES:
+        if name in candidates:
+            return candidates[name]
+    return None
+
+
+class SocTemperatureReader(object):
+    """
+    Reads the SoC temperature from the sysfs file found at startup, keeping it open
+    between reads. Falls back to psutil when no sensor file was found.
+    """
+
+    def __init__(self, root="/sys"):
+        self._logger = logging.getLogger(__name__)
+        self._fd = None
+        self.path = find_soc_sensor(root)
+        if self.path:
+            self._logger.info("Reading SoC temperature from " + self.path)
+        else:
+            self._logger.info("No SoC temperature sensor found, using psutil")
+
+    def read(self):
+        if self.path:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDONLY)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                return int(os.read(self._fd, 32)) / 1000.0
+            except (OSError, ValueError) as e:
+                self._logger.warning("Unable to read " + self.path + ": " + str(e))
+                self.close()
+                self.path = None
+        return self._read_psutil()
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def _read_psutil(self):
+        import psutil
+
+        if hasattr(psutil, "sensors_temperatures"):
+            temps = psutil.sensors_temperatures()
+            if temps:
+                for name in SOC_SENSOR_NAMES:
+                    if name in temps:
+                        return temps[name][0].current
+        return None
@@ -0,0 +1,85 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Record kinds
+TRACE_EVENT = "e"
+TRACE_PROGRESS = "p"
+TRACE_MESSAGE = "m"
+
+
+class TraceRecorder(object):
+    """
+    Appends event, progress and control message records to a trace file, one
+    compact JSON array per line: [time, kind, ...fields]. Records are handed to a
+    background writer so recording never blocks the caller.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self._logger = logging.getLogger(__name__)
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._thread = threading.Thread(target=self._run, name="HomeAssistantTrace")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, kind, *fields):
+        if not self._stopped:
+            self._records.append((time.time(), kind, fields))
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(5)
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                self._wakeup.wait(self.flush_interval)
+                stopped = self._stopped
+                while self._records:
+                    timestamp, kind, fields = self._records.popleft()
+                    record = [round(timestamp, 3), kind]
+                    record.extend(_jsonable(v) for v in fields)
+                    try:
+                        line = json.dumps(record, separators=(",", ":"), default=str)
+                    except Exception as e:
+                        self._logger.warning("Unable to record trace: " + str(e))
+                        continue
+                    f.write(line + "\n")
+                f.flush()
+                if stopped:
+                    return
+
+
+def _jsonable(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def read_trace(path):
+    """Yield the records of a trace file as (time, kind, fields) tuples."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            yield record[0], record[1], record[2:]
+
+
+def trace_path(folder):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, "trace-" + time.strftime("%Y%m%d-%H%M%S") + ".jsonl")
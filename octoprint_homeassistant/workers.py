@@ -0,0 +1,167 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# What happens to a message for a handler that is already queued or running
+POLICY_QUEUE = "queue"  # queue every message
+POLICY_COALESCE = "coalesce"  # replace the queued message with the newest one
+POLICY_DROP = "drop"  # drop the message
+
+
+class HandlerPool(object):
+    """
+    Runs MQTT control handlers on a small set of worker threads so the MQTT client
+    thread never blocks on them.
+
+    Messages for the same handler are handled one at a time, in order. The number of
+    queued messages is limited by max_pending. A worker that runs a handler longer
+    than its timeout is given up on and replaced, so a hanging handler can't take
+    the whole pool down with it.
+    """
+
+    def __init__(self, workers=2, max_pending=16, max_workers=None):
+        self._logger = logging.getLogger(__name__)
+        self._workers = workers
+        self._max_workers = max_workers or workers * 2
+        self._max_pending = max_pending
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._running = {}
+        self._threads = set()
+        self._abandoned = set()
+        self._sequence = 0
+        self._stopped = False
+
+    def wrap(self, handler, policy=POLICY_QUEUE, timeout=30):
+        """Return an MQTT subscribe callback that runs handler on the pool."""
+
+        def callback(topic, message, retained=None, qos=None, *args, **kwargs):
+            self.submit(
+                handler,
+                (topic, message, retained, qos) + args,
+                kwargs,
+                policy=policy,
+                timeout=timeout,
+            )
+
+        return callback
+
+    def submit(self, handler, args=(), kwargs=None, policy=POLICY_QUEUE, timeout=30):
+        name = handler.__name__
+        with self._condition:
+            if self._stopped:
+                return False
+
+            self._reap()
+
+            busy = name in self._pending or any(
+                job[0] == name for job in self._running.values()
+            )
+            if policy == POLICY_DROP and busy:
+                self._logger.debug("Handler " + name + " busy, dropping message")
+                return False
+
+            if policy == POLICY_COALESCE and name in self._pending:
+                self._pending[name] = (handler, args, kwargs or {}, timeout)
+                return True
+
+            if len(self._pending) >= self._max_pending:
+                self._logger.warning(
+                    "Handler queue full, dropping message for " + name
+                )
+                return False
+
+            if policy == POLICY_QUEUE:
+                self._sequence += 1
+                key = (name, self._sequence)
+            else:
+                key = name
+            self._pending[key] = (handler, args, kwargs or {}, timeout)
+
+            if len(self._threads) < self._workers:
+                self._start_worker()
+            self._condition.notify()
+            return True
+
+    def join(self, timeout=None):
+        """Wait until all queued messages are handled, returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify_all()
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._work, name="HomeAssistantHandler")
+        thread.daemon = True
+        self._threads.add(thread)
+        thread.start()
+
+    def _reap(self):
+        # Replace workers that are stuck in a handler past its timeout
+        now = time.time()
+        for thread, (name, started, timeout) in list(self._running.items()):
+            if not timeout or now - started < timeout:
+                continue
+            self._logger.warning(
+                "Handler "
+                + name
+                + " exceeded its timeout of "
+                + str(timeout)
+                + "s, replacing worker"
+            )
+            self._threads.discard(thread)
+            self._abandoned.add(thread)
+            del self._running[thread]
+            if len(self._threads) + len(self._abandoned) < self._max_workers:
+                self._start_worker()
+
+    def _next_job(self):
+        running = set(job[0] for job in self._running.values())
+        for key, job in self._pending.items():
+            if job[0].__name__ not in running:
+                del self._pending[key]
+                return job
+        return None
+
+    def _work(self):
+        thread = threading.current_thread()
+        while True:
+            with self._condition:
+                job = None
+                while not self._stopped:
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self._condition.wait()
+                if job is None:
+                    self._threads.discard(thread)
+                    return
+                handler, args, kwargs, timeout = job
+                self._running[thread] = (handler.__name__, time.time(), timeout)
+
+            try:
+                handler(*args, **kwargs)
+            except Exception:
+                self._logger.exception("Error in handler " + handler.__name__)
+            finally:
+                with self._condition:
+                    self._running.pop(thread, None)
+                    self._condition.notify_all()
+                    if thread in self._abandoned:
+                        # Replaced while it was stuck, leave the work to the others
+                        self._abandoned.discard(thread)
+                        return